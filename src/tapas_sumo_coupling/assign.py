@@ -34,6 +34,7 @@ import sumolib
 from sumolib.miscutils import working_dir, benchmark
 import cutRoutes
 
+from tapas_sumo_coupling import manifest
 from tapas_sumo_coupling.common import abspath_in_dir
 from tapas_sumo_coupling.constants import TAPAS_EXTRA_TIME
 
@@ -106,16 +107,20 @@ def run_duaiterate(options, first_depart, last_depart, trip_file, weight_file, m
         'duarouter--vtype-output', '/dev/null',
         'duarouter--routing-threads', '16',
     ]
+    routes = abspath_in_dir(
+        dua_dir, "vehroute_%03i.xml" % (options.last_step - 1))
+    weights = abspath_in_dir(
+        dua_dir, "dump_%03i_%s.xml" % (options.last_step - 1, aggregation))
+    stage = manifest.Stage("duaIterate", [routes, weights], [options.net_file] + trips + additional, {"args": params})
+    if stage.skip(options.resume):
+        return routes, weights
+
     with open(abspath_in_dir(dua_dir, 'duaIterate.cfg'), 'w') as f:
         print(duaIterate.initOptions().parse_args(args=params).config_as_string, file=f)
 
     with working_dir(dua_dir):
         duaIterate.main(params)
-
-    routes = abspath_in_dir(
-        dua_dir, "vehroute_%03i.xml" % (options.last_step - 1))
-    weights = abspath_in_dir(
-        dua_dir, "dump_%03i_%s.xml" % (options.last_step - 1, aggregation))
+    stage.record(options.resume)
     return routes, weights
 
 
@@ -128,9 +133,6 @@ def run_oneshot(options, first_depart, last_depart, trip_file, weight_file, meso
     oneshot_routes = abspath_in_dir(
         oneshot_dir, 'vehroutes_%s.rou.xml' % suffix)
     oneshot_weights = abspath_in_dir(oneshot_dir, 'aggregated_%s.xml' % suffix)
-    if os.path.exists(oneshot_routes) and options.resume:
-        print("Route file", oneshot_routes, "exists! Skipping assignment.")
-        return oneshot_routes, oneshot_weights
     aggregation = 1800
     begin = (int(first_depart) / aggregation) * aggregation
     additional = [options.vtype_file, 'dump_' + suffix + '.xml']
@@ -154,6 +156,13 @@ def run_oneshot(options, first_depart, last_depart, trip_file, weight_file, meso
     additional += sorted(specificPT if specificPT else glob.glob(os.path.join(base_dir, 'pt*.xml*')))
     additional += sorted(glob.glob(os.path.join(base_dir, 'fleet*.xml*')), reverse=True)
 
+    stage = manifest.Stage("oneshot", [oneshot_routes, oneshot_weights],
+                           [options.net_file, extra_cfg] + trips + additional[:1] + additional[2:],
+                           {"meso": meso, "options": extra_opt, "begin": begin, "end": last_depart + TAPAS_EXTRA_TIME,
+                            "trip_emissions": options.trip_emissions})
+    if stage.skip(options.resume):
+        return oneshot_routes, oneshot_weights
+
     tempcfg = abspath_in_dir(oneshot_dir, '%s_temp.sumocfg' % suffix)
     addOpt = ""
     if meso:
@@ -232,6 +241,7 @@ def run_oneshot(options, first_depart, last_depart, trip_file, weight_file, meso
         os.remove(tempcfg)
         subprocess.check_call(
             [sumolib.checkBinary('sumo'), "-c", oneshotcfg, "-v"])
+    stage.record(options.resume)
     return oneshot_routes, oneshot_weights
 
 
@@ -244,8 +254,8 @@ def run_bulk(options, first_depart, last_depart, trip_file, weight_file):
     additional = [options.vtype_file] + pt_files[:-1]
     if options.bidi_taz_file:
         additional.append(options.bidi_taz_file)
-    if os.path.exists(route_file) and options.resume:
-        print("Route file", route_file, "exists! Skipping computation.")
+    stage = manifest.Stage("bulk", [route_file], [options.net_file, weight_file] + input_files + additional)
+    if stage.skip(options.resume):
         return route_file, weight_file
     duarouter_args = [
         sumolib.checkBinary('duarouter'),
@@ -271,6 +281,7 @@ def run_bulk(options, first_depart, last_depart, trip_file, weight_file):
     subprocess.check_call(duarouter_args + ["--save-configuration", base + ".duarcfg"])
     with open(base + '.log', 'w') as f:
         subprocess.check_call([sumolib.checkBinary('duarouter'), base + ".duarcfg"], stderr=f, stdout=f)
+    stage.record(options.resume)
     return route_file, weight_file
 
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# Copyright (C) 2013-2025 German Aerospace Center (DLR) and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file    columnar.py
+# @author  agent
+# @date    2026-10-18
+
+# Reading and writing trip files either as CSV or as a directory of memory
+# mapped numpy column files (recognized by the suffix .cols). Every column is
+# stored dictionary encoded as <field>.npy (int32 codes) and <field>.values.npy
+# (the distinct strings) so conversions need to be done only once per value.
+
+from __future__ import print_function, division
+import os
+import csv
+import shutil
+from collections import defaultdict
+
+import numpy as np
+
+SUFFIX = ".cols"
+FIELDS_FILE = "columns.txt"
+CODES_SUFFIX = ".codes"  # raw codes of a column while writing
+CODE_TYPE = np.int32
+WRITE_CHUNK_ROWS = 1 << 18  # rows collected before the codes are appended to the column files
+
+
+def is_columnar(path):
+    return path.endswith(SUFFIX)
+
+
+class CSVTripWriter:
+    """csv.DictWriter which also accepts rows given as sequences"""
+
+    def __init__(self, path, fieldnames, lineterminator='\r\n'):
+        self._file = open(path, 'w')
+        self._dict_writer = csv.DictWriter(self._file, fieldnames, extrasaction='ignore', lineterminator=lineterminator)
+        self._writer = csv.writer(self._file, lineterminator=lineterminator)
+        self._dict_writer.writeheader()
+
+    def writerow(self, row):
+        self._dict_writer.writerow(row)
+
+    def writetuples(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ColumnTripWriter:
+    """Collects the dictionary encoded columns in a temporary directory next to the target.
+    The codes are flushed in chunks, only the distinct values stay in memory. The directory
+    is renamed into place on close, after an exception it is removed instead."""
+
+    def __init__(self, path, fieldnames):
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self._tmp = "%s.tmp%s" % (path, os.getpid())
+        if os.path.isdir(self._tmp):
+            shutil.rmtree(self._tmp)
+        os.makedirs(self._tmp)
+        self._indices = []
+        self._codes = []
+        self._files = []
+        self._count = 0
+        for field in self.fieldnames:
+            index = defaultdict()
+            index.default_factory = index.__len__
+            self._indices.append(index)
+            self._codes.append([])
+            self._files.append(open(os.path.join(self._tmp, field + CODES_SUFFIX), 'wb'))
+
+    def writerow(self, row):
+        for field, index, codes in zip(self.fieldnames, self._indices, self._codes):
+            value = row.get(field)
+            codes.append(index['' if value is None else str(value)])
+        self._maybe_flush()
+
+    def writetuples(self, rows):
+        columns = list(zip(*rows))
+        for column, index, codes in zip(columns, self._indices, self._codes):
+            codes.extend(map(index.__getitem__, ['' if v is None else str(v) for v in column]))
+        self._maybe_flush()
+
+    def _maybe_flush(self, force=False):
+        if self._codes and (force or len(self._codes[0]) >= WRITE_CHUNK_ROWS):
+            for codes, f in zip(self._codes, self._files):
+                np.array(codes, CODE_TYPE).tofile(f)
+            self._count += len(self._codes[0])
+            for codes in self._codes:
+                del codes[:]
+
+    def close(self):
+        self._maybe_flush(True)
+        with open(os.path.join(self._tmp, FIELDS_FILE), 'w') as f:
+            f.write("\n".join(self.fieldnames) + "\n")
+        header = {'descr': np.dtype(CODE_TYPE).str, 'fortran_order': False, 'shape': (self._count,)}
+        for field, index, codes_file in zip(self.fieldnames, self._indices, self._files):
+            codes_file.close()
+            with open(codes_file.name, 'rb') as raw, open(os.path.join(self._tmp, field + ".npy"), 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(raw, f)
+            os.remove(codes_file.name)
+            np.save(os.path.join(self._tmp, field + ".values.npy"), np.array(list(index) or [''], str))
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self._tmp, self.path)
+
+    def abort(self):
+        for f in self._files:
+            f.close()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_writer(path, fieldnames, lineterminator='\r\n'):
+    """returns a writer for trip rows (dicts via writerow or sequences via writetuples),
+       the header is written already if it is a CSV file"""
+    if is_columnar(path):
+        return ColumnTripWriter(path, fieldnames)
+    return CSVTripWriter(path, fieldnames, lineterminator)
+
+
+def get_fieldnames(path):
+    if is_columnar(path):
+        with open(os.path.join(path, FIELDS_FILE)) as f:
+            return f.read().split()
+    with open(path) as f:
+        return next(csv.reader(f), [])
+
+
+def read_column(path, field, conversion=None, dtype=None):
+    """returns a single column of a columnar trip file as numpy array,
+       applying the conversion once for every distinct value"""
+    codes = np.load(os.path.join(path, field + ".npy"), mmap_mode='r')
+    values = np.load(os.path.join(path, field + ".values.npy"))
+    if conversion is not None:
+        values = np.array([conversion(v) for v in values.tolist()], dtype)
+    return values[codes]
+
+
+def read_columns(path, fields=None):
+    """returns a dict of the given columns (all if fields is None) as lists of strings"""
+    if fields is None:
+        fields = get_fieldnames(path)
+    if is_columnar(path):
+        return dict([(f, read_column(path, f).tolist()) for f in fields])
+    with open(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        indices = [header.index(field) for field in fields]
+        columns = [[] for _ in fields]
+        for row in reader:
+            for idx, column in zip(indices, columns):
+                column.append(row[idx])
+    return dict(zip(fields, columns))
+
+
+def tuple_generator(path, fields):
+    """yields the values of the given fields for every trip as tuple,
+       columnar files are read in chunks of the memory mapped codes"""
+    if not is_columnar(path):
+        with open(path) as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            indices = [header.index(field) for field in fields]
+            for row in reader:
+                yield tuple([row[idx] for idx in indices])
+        return
+    codes = [np.load(os.path.join(path, f + ".npy"), mmap_mode='r') for f in fields]
+    values = [np.load(os.path.join(path, f + ".values.npy")) for f in fields]
+    for begin in range(0, len(codes[0]) if codes else 0, WRITE_CHUNK_ROWS):
+        for row in zip(*[v[c[begin:begin + WRITE_CHUNK_ROWS]].tolist() for c, v in zip(codes, values)]):
+            yield row
+
+
+def row_generator(path, fields=None):
+    """yields every trip as a dict, restricted to the given fields for columnar files"""
+    if not is_columnar(path):
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                yield row
+        return
+    if fields is None:
+        fields = get_fieldnames(path)
+    for values in tuple_generator(path, fields):
+        yield dict(zip(fields, values))
+
+
+def remove_trips(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def copy_trips(source, dest):
+    """copies a trip file converting between CSV and columnar format if needed"""
+    if is_columnar(source) == is_columnar(dest):
+        if is_columnar(source):
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            shutil.copytree(source, dest)
+        else:
+            shutil.copyfile(source, dest)
+        return
+    fieldnames = get_fieldnames(source)
+    columns = read_columns(source, fieldnames)
+    with open_writer(dest, fieldnames, '\n') as writer:
+        writer.writetuples(zip(*[columns[f] for f in fieldnames]))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit("usage: %s <input> <output> (converts between .csv and %s)" % (sys.argv[0], SUFFIX))
+    copy_trips(sys.argv[1], sys.argv[2])
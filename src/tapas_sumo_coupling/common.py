@@ -21,8 +21,17 @@ import subprocess
 import os
 import sys
 import csv
+import random
+import shutil
+from collections import defaultdict
 
-from tapas_sumo_coupling import constants
+import numpy as np
+
+from tapas_sumo_coupling import constants, columnar
+
+
+class MappingError(Exception):
+    pass
 
 
 def abspath_in_dir(d, f):
@@ -44,6 +53,52 @@ def ensure_dir(dir):
         os.mkdir(dir)
 
 
+def hash_file(digest, path):
+    """feeds the content of the file into the given hashlib digest"""
+    with open(path, "rb") as inp:
+        for chunk in iter(lambda: inp.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(b"\0")
+
+
+def link_file(source, dest):
+    """hardlinks source to dest replacing dest, copies if linking is not possible (e.g. across file systems)"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+
+def materialize_file(source, dest, mode="copy"):
+    """makes the source file available as dest by copying, hardlinking or symlinking it,
+       linked files need to be unshared (see unshare_file) before they get modified"""
+    if mode == "hardlink":
+        link_file(source, dest)
+    elif mode == "symlink":
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.symlink(os.path.abspath(source), dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+    else:
+        shutil.copyfile(source, dest)
+
+
+def unshare_file(path, keep_content=True):
+    """replaces a symlinked or hardlinked file by a private one, so that writing to it
+       does not modify the template it was materialized from"""
+    if os.path.islink(path) or (os.path.isfile(path) and os.stat(path).st_nlink > 1):
+        if keep_content:
+            tmp = "%s.tmp%s" % (path, os.getpid())
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, path)
+        else:
+            os.remove(path)
+
+
 def listdir_skip_hidden(dir_path):
     assert os.path.isdir(dir_path), dir_path
     dir_list = [ff for ff in os.listdir(dir_path) if not ff[0] == '.']
@@ -72,20 +127,121 @@ def chunked_sequence_generator(sequence, markerfunc, assertUniqe=False):
         yield marker, chunk
 
 
-def csv_sequence_generator(csvfile, fields, assertUniqe=False):
+def csv_sequence_generator(csvfile, fields, assertUniqe=False, columns=None):
+    # csvfile may also be a columnar trip file, then only the given columns are read
     if type(fields) == str:
         fields = [fields]
     gen = chunked_sequence_generator(
-        csv.DictReader(open(csvfile)),
+        columnar.row_generator(csvfile, columns),
         lambda row: tuple([row[f] for f in fields]),
         assertUniqe)
     for item in gen:
         yield item
 
+
+class TripTable:
+    """Column store of a tapas trip file which is read in a single pass.
+    Every column is kept as an index array into the list of its distinct values,
+    start and end coordinates share a common list of (lon, lat) locations."""
+
+    def __init__(self, csvfile, chunk_size=100000):
+        self.values = {}
+        self.codes = {}
+        location_index = defaultdict()
+        location_index.default_factory = location_index.__len__
+        with open(csvfile) as f:
+            reader = csv.reader(f)
+            self.fieldnames = next(reader, [])
+            indices = [defaultdict() for _ in self.fieldnames]
+            for index in indices:
+                index.default_factory = index.__len__
+            chunks = [[] for _ in self.fieldnames]
+            source_chunks = []
+            dest_chunks = []
+            while True:
+                rows = [row for _, row in zip(range(chunk_size), reader)]
+                if not rows:
+                    break
+                columns = dict(zip(self.fieldnames, zip(*rows)))
+                source_chunks.append(np.fromiter(map(location_index.__getitem__, zip(
+                    columns[constants.TH.source_long], columns[constants.TH.source_lat])), np.int32, len(rows)))
+                dest_chunks.append(np.fromiter(map(location_index.__getitem__, zip(
+                    columns[constants.TH.dest_long], columns[constants.TH.dest_lat])), np.int32, len(rows)))
+                for field, index, chunk in zip(self.fieldnames, indices, chunks):
+                    chunk.append(np.fromiter(map(index.__getitem__, columns[field]), np.int32, len(rows)))
+        for field, index, chunk in zip(self.fieldnames, indices, chunks):
+            self.values[field] = list(index)
+            self.codes[field] = np.concatenate(chunk) if chunk else np.zeros(0, np.int32)
+        self.location_index = dict(location_index)
+        self.locations = list(location_index)
+        self.source = np.concatenate(source_chunks) if source_chunks else np.zeros(0, np.int32)
+        self.dest = np.concatenate(dest_chunks) if dest_chunks else np.zeros(0, np.int32)
+        self.num_rows = len(self.source)
+        self.person_starts = self._get_person_starts(csvfile)
+
+    def _get_person_starts(self, csvfile):
+        """returns the first row of every person (and the number of rows as sentinel),
+           asserting that each person appears only in one consecutive sequence of rows"""
+        if self.num_rows == 0:
+            return np.zeros(1, np.int64)
+        pid = self.codes[constants.TH.person_id].astype(np.int64)
+        hh = self.codes[constants.TH.household_id]
+        key = pid * len(self.values[constants.TH.household_id]) + hh
+        starts = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+        order = np.argsort(key[starts], kind="stable")
+        duplicates = order[1:][key[starts][order[1:]] == key[starts][order[:-1]]]
+        if len(duplicates) > 0:
+            marker = self.get(constants.TH.person_id, starts[duplicates.min()]), self.get(constants.TH.household_id, starts[duplicates.min()])
+            raise Exception('Marker %s appears twice in sequence %s.' % (marker, csvfile))
+        return np.append(starts, self.num_rows)
+
+    def get(self, field, row):
+        return self.values[field][self.codes[field][row]]
+
+    def column(self, field, rows):
+        """returns the string values of the given column for the given row indices"""
+        if field not in self.codes:
+            return [''] * len(rows)
+        return list(map(self.values[field].__getitem__, self.codes[field][rows].tolist()))
+
+    def converted(self, field, conversion, dtype):
+        """returns the whole column converted to a numpy array (converting every distinct value only once)"""
+        return np.array([conversion(v) for v in self.values[field]], dtype)[self.codes[field]]
+
+    def location_column(self, locations, coord):
+        return [self.locations[l][coord] for l in locations.tolist()]
+
+
 def build_uid(row, clone_idx=0):
     # build unique id for each trip
     return '%s_%s_%s_%s' % (row[constants.TH.person_id], row[constants.TH.household_id], int(row[constants.TH.depart_minute]), clone_idx)
 
+
+def parse_uid(vehicle_id):
+    # split a trip id into its components, the vehicles of a clone flow
+    # get the clone index they would have as separate trips
+    uid = vehicle_id.split('_')
+    prefix = constants.CLONE_FLOW_SUFFIX + '.'
+    if uid[-1].startswith(prefix):
+        uid[-1] = str(int(uid[-1][len(prefix):]) + 1)
+    return tuple(uid)
+
+
+def resolve_uid(vehicle):
+    # the vehicles of a flow of identical trips carry the ids of all trips
+    # in a parameter, SUMO numbers them <flow id>.<index> in this order
+    for param in vehicle.param or []:
+        if param.key == constants.TRIP_GROUP_PARAM:
+            return param.value.split()[int(vehicle.id.rsplit('.', 1)[1])]
+    return vehicle.id
+
+
+def person_random(seed, person_id, household_id, stage):
+    # random number generator for a single person which does not depend on
+    # the order (or the process) in which the persons are handled
+    return random.Random('%s_%s_%s_%s' % (stage, seed, person_id, household_id))
+
+
 def parseTaz(moving):
     fromTaz = None
     toTaz = None
@@ -19,6 +19,8 @@
 TAPAS_DAY_OVERLAP_MINUTES = 60 * 4  # do not allow the day to reach further into the next or last day
 TAPAS_EXTRA_TIME = 3600 * 3  # allow for some stragglers / late night activities
 BACKGROUND_TRAFFIC_SUFFIX = 'b'
+CLONE_FLOW_SUFFIX = 'clones'  # SUMO names the vehicles of such a flow <flow id>.<index>
+TRIP_GROUP_PARAM = 'tripGroup'  # param listing the trip ids of a flow of identical trips
 
 
 # (T)APAS (H)eader fields
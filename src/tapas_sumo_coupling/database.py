@@ -21,9 +21,15 @@
 from __future__ import print_function
 import os
 import sys
+import re
 import subprocess
 import multiprocessing
 import time
+import io
+import csv
+import queue
+import collections
+from multiprocessing.pool import ThreadPool
 
 import sqlite3
 try:
@@ -35,6 +41,14 @@ except ImportError:
 sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
 from sumolib.options import ArgumentParser
 
+BULK_BATCH_SIZE = 100000  # rows per COPY when loading into postgres
+COPY_NULL = r"\N"
+# sqlite settings during a bulk load, the previous values are restored afterwards
+SQLITE_BULK_PRAGMAS = (("synchronous", "OFF"), ("journal_mode", "MEMORY"), ("cache_size", "-262144"))
+STAGING_SUFFIX = "_staging"
+PRIMARY_KEY_PATTERN = re.compile(r",\s*CONSTRAINT\s+(\S+)\s+PRIMARY KEY\s*\(([^)]*)\)", re.IGNORECASE)
+STAGING_COMMENT = "staging table, primary key: %s"  # the comment lets finish_table restore the primary key
+
 
 def add_db_arguments(argParser):
     argParser.add_argument("--host", help="postgres server name or IP (or 'sqlite3' for a local sqlite database)")
@@ -44,6 +58,8 @@ def add_db_arguments(argParser):
     argParser.add_argument("--database", default="tapas", help="postgres server database name")
     argParser.add_argument("--read-only", action="store_true", default=False,
                            help="only read from the database but never write")
+    argParser.add_argument("--db-connections", type=int, default=1,
+                           help="number of parallel postgres connections for large downloads and uploads")
 
 
 def get_conn(options_or_config_file, conn=None):
@@ -111,23 +127,144 @@ def execute(conn, command, parameters):
     conn.commit()
 
 
-def insertmany(conn, table, columns, parameters):
-    if not parameters:
-        return
+def executemany(conn, command, parameters):
+    """executes the command for all parameter tuples in a single transaction (without any bulk tuning)"""
     cursor = conn.cursor()
+    if not isinstance(conn, sqlite3.Connection):
+        command = command.replace('?', '%s')
+    cursor.executemany(command, parameters)
+    conn.commit()
+
+
+def _array_literal(value):
+    return "{%s}" % ", ".join(["NULL" if v is None else _array_literal(v) if isinstance(v, (tuple, list)) else str(v)
+                               for v in value])
+
+
+def _copy_row(row):
+    return [COPY_NULL if v is None else _array_literal(v) if isinstance(v, (tuple, list)) else v for v in row]
+
+
+def _batches(parameters, size):
+    batch = []
+    for row in parameters:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_batch(conn, command, batch):
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows([_copy_row(row) for row in batch])
+    buf.seek(0)
+    conn.cursor().copy_expert(command, buf)
+
+
+def _copy_parallel(conns, command, batches):
+    """copies the batches using all connections in parallel, keeping only a few batches in memory"""
+    idle = queue.Queue()
+    for conn in conns:
+        idle.put(conn)
+
+    def copy(batch):
+        conn = idle.get()
+        try:
+            _copy_batch(conn, command, batch)
+        finally:
+            idle.put(conn)
+
+    pool = ThreadPool(len(conns))
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            if len(pending) >= 2 * len(conns):
+                pending.popleft().get()
+            pending.append(pool.apply_async(copy, (batch,)))
+        while pending:
+            pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _insert_sqlite(conn, table, columns, parameters):
+    cursor = conn.cursor()
+    schema = table.split(".")[0] if "." in table else "main"
+    # the journal mode cannot be changed inside a transaction and the caller's transaction is not ours to commit
+    pragmas = [] if conn.in_transaction else SQLITE_BULK_PRAGMAS
+    previous = [(p, cursor.execute("PRAGMA %s.%s" % (schema, p)).fetchone()[0]) for p, _ in pragmas]
+    for pragma, value in pragmas:
+        cursor.execute("PRAGMA %s.%s = %s" % (schema, pragma, value))
     try:
-        command = "INSERT INTO %s(%s) VALUES " % (table, columns)
-        if isinstance(conn, sqlite3.Connection):
-            command += '(%s)' % (", ".join(len(parameters[0]) * ["?"]))
-            cursor.executemany(command, parameters)
+        command = None
+        for batch in _batches(parameters, BULK_BATCH_SIZE):
+            if command is None:
+                command = "INSERT INTO %s(%s) VALUES (%s)" % (table, columns, ", ".join(len(batch[0]) * ["?"]))
+            cursor.executemany(command, [[_array_literal(v) if isinstance(v, (tuple, list)) else v for v in row]
+                                         for row in batch])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        for pragma, value in previous:
+            cursor.execute("PRAGMA %s.%s = %s" % (schema, pragma, value))
+
+
+def insertmany(conn, table, columns, parameters, options=None):
+    """Bulk loads the rows given by the (possibly lazy) iterable parameters. Tuple or list values
+    are written as arrays. Postgres loads batches of rows using COPY in a single transaction
+    per connection. If options request more db connections, the batches are distributed over
+    parallel connections which all commit only after every batch was loaded and roll back
+    otherwise. Sqlite inserts all rows in a single transaction."""
+    if isinstance(conn, sqlite3.Connection):
+        _insert_sqlite(conn, table, columns, parameters)
+        return
+    command = "COPY %s(%s) FROM STDIN WITH (FORMAT csv, NULL '%s')" % (table, columns, COPY_NULL)
+    conns = [conn]
+    try:
+        connections = options.db_connections if options is not None else 1
+        while len(conns) < connections:
+            extra = get_conn(options)
+            if extra is None:
+                break
+            conns.append(extra)
+        if len(conns) == 1:
+            for batch in _batches(parameters, BULK_BATCH_SIZE):
+                _copy_batch(conn, command, batch)
         else:
-            psycopg2.extras.execute_values(cursor, command + '%s', parameters)
+            _copy_parallel(conns, command, _batches(parameters, BULK_BATCH_SIZE))
+        for c in conns:
+            c.commit()
     except psycopg2.errors.ReadOnlySqlTransaction as e:
         print(e)
-    conn.commit()
+        for c in conns:
+            c.rollback()
+    except BaseException:
+        for c in conns:
+            c.rollback()
+        raise
+    finally:
+        for extra in conns[1:]:
+            extra.close()
 
 
-def create_table(conn, schema, table, createQuery):
+def _grant_admin(cursor, schema_table):
+    cursor.execute("SELECT 1 FROM pg_roles WHERE rolname='tapas_admin_group'")
+    if len(cursor.fetchall()) > 0:
+        cursor.execute("GRANT ALL PRIVILEGES ON TABLE %s TO tapas_admin_group" % schema_table)
+
+
+def create_table(conn, schema, table, createQuery, staging=False):
+    """Creates the table (dropping an existing one) and returns its name including the schema.
+    If the table cannot be created, the name gets the suffix _fallback.
+    With staging (and postgres) an unlogged table without the primary key is created under a
+    different name and finish_table needs to be called after loading the data."""
+    if staging and not isinstance(conn, sqlite3.Connection):
+        return _create_staging_table(conn, schema, table, createQuery)
     schema_table, table, _ = check_schema_table(conn, schema, table)
     cursor = conn.cursor()
     try:
@@ -140,13 +277,138 @@ def create_table(conn, schema, table, createQuery):
         cursor.execute("DROP TABLE IF EXISTS " + schema_table)
         cursor.execute(createQuery % (schema_table, table))
     if not isinstance(conn, sqlite3.Connection):
-        cursor.execute("SELECT 1 FROM pg_roles WHERE rolname='tapas_admin_group'")
-        if len(cursor.fetchall()) > 0:
-            cursor.execute("GRANT ALL PRIVILEGES ON TABLE %s TO tapas_admin_group" % schema_table)
+        _grant_admin(cursor, schema_table)
     conn.commit()
     return schema_table
 
 
+def _create_staging_table(conn, schema, table, createQuery):
+    staging = table + STAGING_SUFFIX
+    schema_staging = "%s.%s" % (schema, staging)
+    query = createQuery % (schema_staging, table)
+    primary_key = PRIMARY_KEY_PATTERN.search(query)
+    if primary_key:
+        query = query[:primary_key.start()] + query[primary_key.end():]
+    query = query.replace("CREATE TABLE", "CREATE UNLOGGED TABLE", 1)
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS " + schema_staging)
+    cursor.execute(query)
+    # the staging table itself records the primary key, so any process (and connection) can finish it
+    cursor.execute("COMMENT ON TABLE %s IS %%s" % schema_staging,
+                   (STAGING_COMMENT % (primary_key.group(2) if primary_key else ""),))
+    conn.commit()
+    return schema_staging
+
+
+def _is_staging(conn, schema_table):
+    return not isinstance(conn, sqlite3.Connection) and schema_table.endswith(STAGING_SUFFIX)
+
+
+def finish_table(conn, schema_table):
+    """Finishes loading a table created by create_table with staging. The primary key is built,
+    the table is made crash safe, swapped into place (replacing the old table in one transaction)
+    and analyzed. Returns the final name of the table which may have the suffix _fallback
+    if the old table could not be replaced.
+    Making the table crash safe (SET LOGGED) rewrites it once and writes it to the WAL as a whole,
+    so the gain of the unlogged load is mainly avoiding the WAL and index maintenance per batch."""
+    if not _is_staging(conn, schema_table):
+        return schema_table
+    schema, staging = schema_table.split(".", 1)
+    table = staging[:-len(STAGING_SUFFIX)]
+    cursor = conn.cursor()
+    cursor.execute("SELECT obj_description(%s::regclass, 'pg_class')", (schema_table,))
+    comment = cursor.fetchone()[0] or ""
+    primary_key = comment[len(STAGING_COMMENT % ""):] if comment.startswith(STAGING_COMMENT % "") else ""
+    if primary_key:
+        cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (%s)" % (schema_table, staging, primary_key))
+    cursor.execute("ALTER TABLE %s SET LOGGED" % schema_table)
+    conn.commit()
+    for suffix in ("", "_fallback"):
+        try:
+            cursor.execute("DROP TABLE IF EXISTS %s.%s%s" % (schema, table, suffix))
+            cursor.execute("ALTER TABLE %s RENAME TO %s%s" % (schema_table, table, suffix))
+            if primary_key:
+                cursor.execute("ALTER INDEX %s.%s_pkey RENAME TO %s%s_pkey" % (schema, staging, table, suffix))
+            break
+        except Exception:
+            if suffix:
+                raise
+            conn.rollback()
+    final_table = "%s.%s%s" % (schema, table, suffix)
+    cursor.execute("COMMENT ON TABLE %s IS NULL" % final_table)
+    _grant_admin(cursor, final_table)
+    conn.commit()
+    cursor.execute("ANALYZE " + final_table)
+    conn.commit()
+    return final_table
+
+
+def abort_table(conn, schema_table):
+    """Drops a table created by create_table with staging after its upload failed,
+    the previous version of the final table stays in place."""
+    if not _is_staging(conn, schema_table):
+        return
+    try:
+        conn.rollback()
+        conn.cursor().execute("DROP TABLE IF EXISTS " + schema_table)
+        conn.commit()
+    except Exception as e:
+        print("Warning! Could not drop the staging table %s." % schema_table, e, file=sys.stderr)
+
+
+def listen(options, channel):
+    """opens a connection listening on the given notification channel, returns None for sqlite
+       (which does not support notifications)"""
+    conn = get_conn(options)
+    if conn is None or isinstance(conn, sqlite3.Connection):
+        if conn is not None:
+            conn.close()
+        return None
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor().execute("LISTEN %s" % channel)
+    return conn
+
+
+def _notify_trigger(table, channel):
+    return "%s_%s" % (table, channel)
+
+
+def install_notify_triggers(conn, channel, tables):
+    """installs triggers which notify the channel on any change of the given public tables
+       (this is a setup step which needs the rights to create functions and triggers)"""
+    cursor = conn.cursor()
+    function = "public.notify_%s" % channel
+    cursor.execute("""CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$
+                      BEGIN PERFORM pg_notify('%s', TG_TABLE_NAME); RETURN NULL; END;
+                      $$ LANGUAGE plpgsql""" % (function, channel))
+    for table in tables:
+        trigger = _notify_trigger(table, channel)
+        cursor.execute("DROP TRIGGER IF EXISTS %s ON public.%s" % (trigger, table))
+        cursor.execute("""CREATE TRIGGER %s AFTER INSERT OR UPDATE ON public.%s
+                          FOR EACH STATEMENT EXECUTE PROCEDURE %s()""" % (trigger, table, function))
+    conn.commit()
+
+
+def get_notifying_tables(conn, channel, tables):
+    """returns the set of the given public tables which have a trigger notifying the channel"""
+    if not tables:
+        return set()
+    cursor = conn.cursor()
+    cursor.execute("""SELECT c.relname FROM pg_trigger t JOIN pg_class c ON t.tgrelid = c.oid
+                      JOIN pg_namespace n ON c.relnamespace = n.oid
+                      WHERE n.nspname = 'public' AND c.relname IN %s AND t.tgname = c.relname || %s""",
+                   (tuple(tables), _notify_trigger("", channel)))
+    return set([row[0] for row in cursor.fetchall()])
+
+
+def consume_notifications(conn):
+    """reads all pending notifications from a listening connection and returns their number"""
+    conn.poll()
+    count = len(conn.notifies)
+    del conn.notifies[:]
+    return count
+
+
 def run_sql(conn, sql):
     cursor = conn.cursor()
     command = ""
@@ -19,6 +19,16 @@
 from __future__ import print_function
 import os
 import sys
+import csv
+import glob
+import hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import defaultdict
+
+import numpy as np
 
 if 'SUMO_HOME' in os.environ:
     tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -28,56 +38,367 @@ else:
 
 import sumolib
 
+CACHE_NONE = r"\N"  # marks a missing taz or vClass in the mapping cache
+
+
+def distance_to_segments(px, py, sx, sy, ex, ey):
+    """Returns the distances of the points to the line segments.
+    Follows sumolib.geomhelper.distancePointToLine operation by operation
+    to get bitwise identical results."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx = sx - ex
+        dy = sy - ey
+        d = np.sqrt(dx * dx + dy * dy)
+        u = (px - sx) * (ex - sx) + (py - sy) * (ey - sy)
+        offset = np.where((d == 0.) | (u < 0.) | (u > d * d), np.where(u < 0., 0., d), u / d)
+        u = offset / d
+        ix = np.where(offset == 0, sx, sx + u * (ex - sx))
+        iy = np.where(offset == 0, sy, sy + u * (ey - sy))
+    dx = px - ix
+    dy = py - iy
+    return np.sqrt(dx * dx + dy * dy)
+
+
+class EdgeIndex:
+    """Spatial index over the edges allowing a single vehicle class,
+    answering neighborhood queries for arrays of coordinates at once.
+    The edges are registered in the cells of a uniform grid covering their bounding boxes.
+    All data are plain numpy arrays which can be saved once and memory mapped
+    by any number of worker processes."""
+
+    ARRAYS = ("ids", "id_rank", "priority", "seg_count", "seg_offset", "sx", "sy", "ex", "ey", "bbox",
+              "grid", "cell_start", "cell_edges", "taz_names", "taz_members")
+
+    def __init__(self, edges, taz):
+        edges = [e for e in edges if len(e.getShape(True)) > 1]
+        self.ids = np.array([e.getID() for e in edges], str)
+        num = len(edges)
+        # distance ties are resolved in favor of the larger edge id
+        self.id_rank = np.empty(num, np.int64)
+        self.id_rank[np.argsort(self.ids, kind="stable")] = np.arange(num)
+        self.priority = np.array([e.getPriority() for e in edges], np.int64)
+        shapes = [e.getShape(True) for e in edges]
+        lengths = np.array([len(shape) for shape in shapes], np.int64)
+        points = np.array([p[:2] for shape in shapes for p in shape], np.float64).reshape(-1, 2)
+        point_offset = np.cumsum(lengths) - lengths
+        self.seg_count = lengths - 1
+        self.seg_offset = np.cumsum(self.seg_count) - self.seg_count
+        seg_start = np.ones(len(points), bool)
+        seg_start[point_offset + lengths - 1] = False
+        seg_start = np.flatnonzero(seg_start)
+        self.sx, self.sy = points[seg_start, 0], points[seg_start, 1]
+        self.ex, self.ey = points[seg_start + 1, 0], points[seg_start + 1, 1]
+        self.bbox = np.zeros((0, 4))
+        if num > 0:
+            self.bbox = np.column_stack((np.minimum.reduceat(points[:, 0], point_offset),
+                                         np.minimum.reduceat(points[:, 1], point_offset),
+                                         np.maximum.reduceat(points[:, 0], point_offset),
+                                         np.maximum.reduceat(points[:, 1], point_offset)))
+        # (taz, edge) memberships encoded as taz_code * num + edge_index
+        index = dict([(e, i) for i, e in enumerate(self.ids.tolist())])
+        self.taz_names = np.array(list(taz), str)
+        members = []
+        for code, taz_edges in enumerate(taz.values()):
+            members += [code * num + index[e] for e in taz_edges if e in index]
+        self.taz_members = np.unique(np.array(members, np.int64))
+        self._build_grid()
+        self._init()
+
+    def _build_grid(self):
+        """registers every edge in all grid cells its bounding box touches,
+           the cells get about the area per edge so most cells hold only a few edges"""
+        num = len(self.bbox)
+        if num == 0:
+            self.grid = np.array([0., 0., 1., 1., 1.])
+            self.cell_start = np.zeros(2, np.int64)
+            self.cell_edges = np.zeros(0, np.int64)
+            return
+        x0, y0 = self.bbox[:, 0].min(), self.bbox[:, 1].min()
+        width, height = self.bbox[:, 2].max() - x0, self.bbox[:, 3].max() - y0
+        cell_size = max(np.sqrt(width * height / num), max(width, height) / num, 1.)
+        nx, ny = int(width // cell_size) + 1, int(height // cell_size) + 1
+        self.grid = np.array([x0, y0, cell_size, nx, ny])
+        cx0, cy0, cx1, cy1 = self._cells(self.bbox[:, 0], self.bbox[:, 1], self.bbox[:, 2], self.bbox[:, 3])
+        edge, cell = self._expand(cx0, cy0, cx1, cy1)
+        order = np.argsort(cell, kind="stable")
+        self.cell_edges = edge[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(nx * ny + 1))
+
+    def _cells(self, xmin, ymin, xmax, ymax):
+        """returns the (clipped) cell ranges covering the given boxes"""
+        x0, y0, cell_size, nx, ny = self.grid.tolist()
+        return (np.clip(((xmin - x0) // cell_size).astype(np.int64), 0, int(nx) - 1),
+                np.clip(((ymin - y0) // cell_size).astype(np.int64), 0, int(ny) - 1),
+                np.clip(((xmax - x0) // cell_size).astype(np.int64), 0, int(nx) - 1),
+                np.clip(((ymax - y0) // cell_size).astype(np.int64), 0, int(ny) - 1))
+
+    def _expand(self, cx0, cy0, cx1, cy1):
+        """returns the box index and the cell number for every cell of the given cell ranges"""
+        nx = int(self.grid[3])
+        cols = cx1 - cx0 + 1
+        counts = cols * (cy1 - cy0 + 1)
+        box = np.repeat(np.arange(len(counts)), counts)
+        pos = np.arange(len(box)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return box, (cy0[box] + pos // cols[box]) * nx + cx0[box] + pos % cols[box]
+
+    def _init(self):
+        self.taz_code = dict([(t, code) for code, t in enumerate(self.taz_names.tolist())])
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory):
+        """attaches to the arrays saved in directory without copying them"""
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="r"))
+        index._init()
+        return index
+
+    def intersection(self, xmin, ymin, xmax, ymax):
+        """returns query index and edge index for all edges whose bounding box intersects
+           the query box, sorted by query and edge"""
+        if len(self.ids) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        query, cell = self._expand(*self._cells(xmin, ymin, xmax, ymax))
+        counts = self.cell_start[cell + 1] - self.cell_start[cell]
+        pair = np.repeat(np.arange(len(cell)), counts)
+        edge = self.cell_edges[self.cell_start[cell][pair] + np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts)]
+        # edges spanning several cells are found more than once
+        key = np.unique(query[pair] * len(self.ids) + edge)
+        query, edge = key // len(self.ids), key % len(self.ids)
+        box = self.bbox[edge]
+        hit = ((box[:, 0] <= xmax[query]) & (box[:, 2] >= xmin[query]) &
+               (box[:, 1] <= ymax[query]) & (box[:, 3] >= ymin[query]))
+        return query[hit], edge[hit]
+
+    def neighbors(self, x, y, radius):
+        """returns query index, edge index and distance for all edges closer than radius"""
+        query, ids = self.intersection(x - radius, y - radius, x + radius, y + radius)
+        if len(ids) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+        # expand every (query, edge) pair to all segments of the edge
+        num_segs = self.seg_count[ids]
+        pair = np.repeat(np.arange(len(ids)), num_segs)
+        first = np.cumsum(num_segs) - num_segs
+        seg = self.seg_offset[ids][pair] + np.arange(len(pair)) - first[pair]
+        dist = distance_to_segments(x[query[pair]], y[query[pair]], self.sx[seg], self.sy[seg], self.ex[seg], self.ey[seg])
+        dist = np.minimum.reduceat(dist, first)
+        close = dist < radius
+        return query[close], ids[close], dist[close]
+
+    def in_taz(self, taz_code, edge):
+        key = taz_code * len(self.ids) + edge
+        pos = np.minimum(np.searchsorted(self.taz_members, key), max(len(self.taz_members) - 1, 0))
+        return (taz_code >= 0) & (len(self.taz_members) > 0) & (self.taz_members[pos] == key)
+
+    def nearest(self, query, edge, dist):
+        """returns the indices of the nearest edge for every query"""
+        order = np.lexsort((-self.id_rank[edge], dist, query))
+        first = np.ones(len(order), bool)
+        first[1:] = query[order][1:] != query[order][:-1]
+        return order[first]
+
+
 class EdgeMapper:
 
-    def init(self, net, taz, location_prios):
+    def init(self, net, taz, location_prios, cache_dir=None, geometry_dir=None, warm_start=True):
         self.net = net
         self.result_cache = {}  # geo-locations are reused frequently
         self.taz = taz
         self.location_prios = location_prios
+        self.indexes = {}  # one spatial index per vClass
+        self.geometry_dir = geometry_dir
+        self.cache_out = None
+        if cache_dir:
+            # warm start from previous runs, new results go to a file per process
+            if warm_start:
+                self.result_cache.update(load_cache(cache_dir))
+            self.cache_out = open(os.path.join(cache_dir, "part_%s.csv" % os.getpid()), "a", buffering=1)
+            _lock(self.cache_out)  # tells compact_cache that the file is still in use
+            self.cache_writer = csv.writer(self.cache_out, lineterminator="\n")
+
+    def close_cache(self):
+        if self.cache_out is not None:
+            self.cache_out.close()
+            self.cache_out = None
+
+    def split_cached(self, keys):
+        """returns the keys with a known result and the others"""
+        cached = []
+        uncached = []
+        for key in keys:
+            (cached if key in self.result_cache else uncached).append(key)
+        return cached, uncached
+
+    def get_index(self, vClass):
+        if vClass not in self.indexes:
+            if self.geometry_dir is not None:
+                self.indexes[vClass] = EdgeIndex.load(os.path.join(self.geometry_dir, str(vClass)))
+            else:
+                edges = [e for e in self.net.getEdges() if vClass is None or e.allows(vClass)]
+                self.indexes[vClass] = EdgeIndex(edges, self.taz)
+        return self.indexes[vClass]
+
+    def export_geometry(self, directory, vClasses):
+        """saves the indexes for the given vClasses to be attached by other processes"""
+        for vClass in vClasses:
+            self.get_index(vClass).save(os.path.join(directory, str(vClass)))
 
     def map_to_edge(self, xycoord, taz=None, vClass=None, min_radius=50, max_radius=1000, tazExcess=2.):
-        key = (xycoord, taz, vClass)
-        if key in self.result_cache:
-            return self.result_cache[key]
-
-        x, y = xycoord
-        minDist = -1
-        minEdge = None
-        minInTazDist = -1
-        minInTazEdge = None
-        minPrioDist = -1
-        minPrioEdge = None
+        return self.map_to_edges([(xycoord, taz, vClass)], min_radius, max_radius, tazExcess)[0]
+
+    def map_to_edges(self, keys, min_radius=50, max_radius=1000, tazExcess=2.):
+        """maps a list of (xycoord, taz, vClass) keys, querying the uncached ones in one batch per vClass"""
+        todo = defaultdict(dict)
+        for key in keys:
+            if key not in self.result_cache:
+                todo[key[2]][key] = None
+        for vClass, batch in todo.items():
+            batch = list(batch)
+            for key, result in zip(batch, self._map_batch(batch, vClass, min_radius, max_radius, tazExcess)):
+                self.result_cache[key] = result
+                if self.cache_out is not None:
+                    self.cache_writer.writerow(_cache_row(key, result))
+        return [self.result_cache[key] for key in keys]
+
+    def _map_batch(self, keys, vClass, min_radius, max_radius, tazExcess):
+        """Searches with radii doubling from min_radius until an edge (and an edge in the taz
+        and one with the location priority if applicable) is found, all edges
+        closer than the final radius are candidates."""
+        index = self.get_index(vClass)
+        num = len(keys)
+        x = np.array([k[0][0] for k in keys], np.float64)
+        y = np.array([k[0][1] for k in keys], np.float64)
+        taz_code = np.array([index.taz_code.get(k[1], -1) for k in keys], np.int64)
+        check_prio = np.array([k[0] in self.location_prios for k in keys], bool)
+        prio = np.array([self.location_prios.get(k[0], 0) for k in keys], np.int64)
+        results = []
+        for _ in range(3):
+            results.append((np.full(num, -1.), np.full(num, -1, np.int64)))
+        (min_dist, min_edge), (taz_dist, taz_edge), (prio_dist, prio_edge) = results
+        active = np.arange(num)
         radius = min_radius
-        checkTaz = taz in self.taz
-        checkPrio = xycoord in self.location_prios
-        while (minEdge is None or checkTaz or checkPrio) and radius <= max_radius:
-            for edge, dist in self.net.getNeighboringEdges(x, y, radius, allowFallback=False):
-                if vClass is None or edge.allows(vClass):
-                    if minEdge is None or dist < minDist or (dist == minDist and minEdge < edge.getID()):
-                        minDist = dist
-                        minEdge = edge.getID()
-                    if minInTazEdge is None or dist < minInTazDist or (dist == minInTazDist and minInTazEdge < edge.getID()):
-                        if taz in self.taz and edge.getID() in self.taz[taz]:
-                            minInTazDist = dist
-                            minInTazEdge = edge.getID()
-                            checkTaz = False
-                    if xycoord in self.location_prios and edge.getPriority() >= self.location_prios[xycoord]:
-                        if minPrioEdge is None or dist < minPrioDist or (dist == minPrioDist and minPrioEdge < edge.getID()):
-                            minPrioDist = dist
-                            minPrioEdge = edge.getID()
-                            checkPrio = False
+        while len(active) > 0 and radius <= max_radius:
+            query, edge, dist = index.neighbors(x[active], y[active], radius)
+            point = active[query]
+            # the edges closer than the radius contain the ones of the smaller radii,
+            # so the nearest ones of this round replace the previous ones
+            for (best_dist, best_edge), valid in zip(results, (np.ones(len(edge), bool),
+                                                               index.in_taz(taz_code[point], edge),
+                                                               check_prio[point] & (index.priority[edge] >= prio[point]))):
+                sel = index.nearest(point[valid], edge[valid], dist[valid])
+                best_dist[point[valid][sel]] = dist[valid][sel]
+                best_edge[point[valid][sel]] = edge[valid][sel]
+            done = ((min_edge[active] >= 0) & ((taz_code[active] < 0) | (taz_edge[active] >= 0))
+                    & (~check_prio[active] | (prio_edge[active] >= 0)))
+            active = active[~done]
             radius *= 2
 
-        if minInTazEdge is not None and minInTazDist < max(min_radius, tazExcess * minDist):
-            minDist = minInTazDist
-            minEdge = minInTazEdge
-        if minPrioEdge is not None:
-            minDist = minPrioDist
-            minEdge = minPrioEdge
-        result = (minDist, minEdge, minInTazEdge, minInTazDist)
-        self.result_cache[key] = result
-        return result
+        use_taz = (taz_edge >= 0) & (taz_dist < np.maximum(min_radius, tazExcess * min_dist))
+        min_dist = np.where(use_taz, taz_dist, min_dist)
+        min_edge = np.where(use_taz, taz_edge, min_edge)
+        min_dist = np.where(prio_edge >= 0, prio_dist, min_dist)
+        min_edge = np.where(prio_edge >= 0, prio_edge, min_edge)
+        ids = index.ids
+        return [(d, str(ids[e]) if e >= 0 else None, str(ids[te]) if te >= 0 else None, td)
+                for d, e, te, td in zip(min_dist.tolist(), min_edge.tolist(), taz_edge.tolist(), taz_dist.tolist())]
+
+
+def _encode_none(value):
+    return CACHE_NONE if value is None else value
+
+
+def _decode_none(value):
+    return None if value == CACHE_NONE else value
+
+
+def _cache_row(key, result):
+    (x, y), taz, vClass = key
+    minDist, minEdge, minInTazEdge, minInTazDist = result
+    return (repr(float(x)), repr(float(y)), _encode_none(taz), _encode_none(vClass), repr(float(minDist)),
+            minEdge or "", minInTazEdge or "", repr(float(minInTazDist)))
+
+
+def _lock(f):
+    """tries to lock the file exclusively, returns whether this succeeded (always on systems without flock)"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_cache_dir(options):
+    """returns the cache directory for the mapping results which is determined
+       by the content of all files influencing the mapping and the maximum radius"""
+    digest = hashlib.sha1()
+    for f in (options.net_file, options.taz_file, options.location_priority_file):
+        if f and os.path.exists(f):
+            with open(f, "rb") as inp:
+                for chunk in iter(lambda: inp.read(1 << 20), b""):
+                    digest.update(chunk)
+        digest.update(b"\0")
+    digest.update(repr(options.max_radius).encode())
+    cache_dir = os.path.join(options.mapping_cache_dir, digest.hexdigest())
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def _read_cache(inp, cache):
+    for row in csv.reader(inp):
+        if len(row) != 8:  # incomplete line from an aborted run
+            continue
+        x, y, taz, vClass, minDist, minEdge, minInTazEdge, minInTazDist = row
+        cache[((float(x), float(y)), _decode_none(taz), _decode_none(vClass))] = (
+            float(minDist), minEdge or None, minInTazEdge or None, float(minInTazDist))
+
+
+def load_cache(cache_dir):
+    cache = {}
+    for f in glob.glob(os.path.join(cache_dir, "*.csv")):
+        with open(f) as inp:
+            _read_cache(inp, cache)
+    return cache
+
+
+def compact_cache(cache_dir):
+    """Merges the results of all processes into a single file and returns the number of entries.
+    Part files which are still locked by a running process are merged but not removed."""
+    cache = {}
+    complete = []
+    try:
+        for f in glob.glob(os.path.join(cache_dir, "*.csv")):
+            inp = open(f)
+            if os.path.basename(f) != "cache.csv" and _lock(inp):
+                # keep the lock until the file is removed
+                complete.append(inp)
+                _read_cache(inp, cache)
+            else:
+                with inp:
+                    _read_cache(inp, cache)
+        tmp = os.path.join(cache_dir, "cache.tmp%s" % os.getpid())
+        with open(tmp, "w") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            for key, result in cache.items():
+                writer.writerow(_cache_row(key, result))
+        os.replace(tmp, os.path.join(cache_dir, "cache.csv"))
+        for inp in complete:
+            try:
+                os.remove(inp.name)
+            except OSError:
+                pass
+    finally:
+        for inp in complete:
+            inp.close()
+    return len(cache)
 
 
 _instance = EdgeMapper()
@@ -90,21 +411,56 @@ def init(options, taz):
         for loc in sumolib.xml.parse(options.location_priority_file, "poi"):
             xy = net.convertLonLat2XY(round(float(loc.lon), 5), round(float(loc.lat), 5))
             location_prios[xy] = int(loc.type)
-    _instance.init(net, taz, location_prios)
+    _instance.init(net, taz, location_prios, getattr(options, "mapping_cache", None))
     _instance.trip_filter = options.script_module.trip_filter if hasattr(options.script_module, "trip_filter") else None
 
 
+def attach(geometry_dir, location_prios, cache_dir=None):
+    """initializes a worker process with the geometry exported by export_geometry,
+       so neither the network nor the taz need to be loaded or transferred,
+       the workers only get uncached keys and therefore do not load the cache"""
+    _instance.init(None, None, location_prios, cache_dir, geometry_dir, warm_start=False)
+    _instance.trip_filter = None
+
+
+def export_geometry(directory, vClasses):
+    _instance.export_geometry(directory, vClasses)
+
+
 def convertLonLat2XY(lon_str, lat_str):
     return _instance.net.convertLonLat2XY(round(float(lon_str), 5), round(float(lat_str), 5))
 
 
+def convert_locations(locations):
+    """projects all (lon_str, lat_str) pairs at once, returning a dict of the xy coordinates"""
+    locations = list(locations)
+    if not locations:
+        return {}
+    lon = np.array([round(float(loc[0]), 5) for loc in locations])
+    lat = np.array([round(float(loc[1]), 5) for loc in locations])
+    x, y = _instance.net.convertLonLat2XY(lon, lat)
+    return dict(zip(locations, zip(x.tolist(), y.tolist())))
+
+
 def trip_filter(row, source, dest):
     return _instance.trip_filter and not _instance.trip_filter(row, source, dest)
 
 
+def close_cache():
+    _instance.close_cache()
+
+
+def split_cached(keys):
+    return _instance.split_cached(keys)
+
+
 def get_location_prios():
     return _instance.location_prios
 
 
 def map_to_edge(xycoord, taz=None, vClass=None, min_radius=50, max_radius=1000, tazExcess=2.):
     return _instance.map_to_edge(xycoord, taz, vClass, min_radius, max_radius, tazExcess)
+
+
+def map_to_edges(keys, min_radius=50, max_radius=1000, tazExcess=2.):
+    return _instance.map_to_edges(keys, min_radius, max_radius, tazExcess)
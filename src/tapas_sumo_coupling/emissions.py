@@ -18,12 +18,12 @@
 
 from __future__ import print_function, division
 import os
-import csv
 from collections import defaultdict
 
 import sumolib
 
 from tapas_sumo_coupling.common import abspath_in_dir, build_uid
+from tapas_sumo_coupling import columnar
 from tapas_sumo_coupling.constants import TH, SP
 from tapas_sumo_coupling.database import table_exists
 
@@ -105,7 +105,8 @@ def modify_vtypes(options, car_types, suffix=""):
     orig_types = {}
     unknown_types = set()
     emission_vtypes = defaultdict(set)
-    for row in csv.DictReader(open(options.mapped_trips)):
+    fields = (TH.person_id, TH.household_id, TH.depart_minute, TH.vtype, TH.car_type)
+    for row in columnar.row_generator(options.mapped_trips, fields):
         sumo_type = row[TH.vtype]
         ct = int(row[TH.car_type])
         emission_class = car_types.get(ct)
@@ -24,6 +24,10 @@ import sys
 import collections
 import random
 import math
+import time
+import shutil
+import sqlite3
+from multiprocessing.pool import ThreadPool
 
 sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
 from sumolib.options import ArgumentParser
@@ -32,6 +36,12 @@ from tapas_sumo_coupling import database
 from tapas_sumo_coupling.constants import TH, MODE, THX, SP, CAR_MODES
 
 ALL_PAIRS = 'all_pairs'
+PERSON_RANGE = '/* person range */'  # placeholder for the restriction of a partial download
+PARAM_KEYS = set(SP.KEYS + list(SP.OPTIONAL.keys()))
+PARAM_CACHE_TTL = 60  # seconds the od slices and table checks of the request discovery stay valid
+_param_cache = {}
+# marks a missing od slice table in the cache (in contrast to a missing row which uses the default slices)
+NO_SLICE_TABLE = object()
 
 
 def parse_args():
@@ -59,68 +69,116 @@ def parse_args():
     return options
 
 
-def get_sim_params(conn, sim_key, overrides):
-    cursor_open = conn.cursor()
-    param_keys = set(SP.KEYS + list(SP.OPTIONAL.keys()))
-    command_dirs = """SELECT param_key, param_value FROM public.simulation_parameters
-                      WHERE sim_key = '%s' AND param_key IN ('%s')
-        """ % (sim_key, "','".join(param_keys))
-    cursor_open.execute(command_dirs)
+def _cached(key, compute):
+    """returns the cached value for key, (re)computing it if it is missing or older than PARAM_CACHE_TTL"""
+    now = time.time()
+    entry = _param_cache.get(key)
+    if entry is None or now - entry[0] > PARAM_CACHE_TTL:
+        entry = (now, compute())
+        _param_cache[key] = entry
+    return entry[1]
+
+
+def _get_od_slices(conn, od_slice_table, od_slice_key):
+    """returns the row with the time slices for the od key (None if there is no such row)
+       or NO_SLICE_TABLE if there is no such table, the result is cached"""
+    def compute():
+        if not database.table_exists(conn, od_slice_table, "core"):
+            return NO_SLICE_TABLE
+        cursor = conn.cursor()
+        cursor.execute("""SELECT "matrixMap_distribution" FROM core.%s WHERE "matrixMap_name" = '%s'""" % (
+            od_slice_table, od_slice_key))
+        return cursor.fetchone()
+    return _cached(("od_slices", od_slice_table, od_slice_key), compute)
+
+
+def _complete_sim_params(conn, db_params, overrides):
     sim_params = dict(SP.OPTIONAL)
-    sim_params.update(dict(cursor_open.fetchall()))
+    sim_params.update(db_params)
     sim_params.update(overrides)
     sim_params[SP.max_iteration] = int(float(sim_params[SP.max_iteration]))
     sim_params[SP.iteration] = int(float(sim_params[SP.iteration]))
 
-    if not database.table_exists(conn, sim_params[SP.od_slice_table], "core"):
+    slices = _get_od_slices(conn, sim_params[SP.od_slice_table], sim_params[SP.od_slice_key])
+    if slices is NO_SLICE_TABLE:
         return None
-    command_timeline = """SELECT "matrixMap_distribution" FROM core.%s WHERE "matrixMap_name" = '%s'""" % (
-        sim_params[SP.od_slice_table], sim_params[SP.od_slice_key])
-    cursor_open.execute(command_timeline)
-    slices = cursor_open.fetchone()
-    if slices:
+    if slices:  # otherwise keep the default slices
         sim_params[SP.od_slices] = slices[0]
-    missing_params = param_keys.difference(set(sim_params.keys()))
-    if len(missing_params) > 0:
+    if PARAM_KEYS.difference(set(sim_params.keys())):
         return None
     return sim_params
 
 
+def get_sim_params(conn, sim_key, overrides):
+    cursor_open = conn.cursor()
+    command_dirs = """SELECT param_key, param_value FROM public.simulation_parameters
+                      WHERE sim_key = '%s' AND param_key IN ('%s')
+        """ % (sim_key, "','".join(PARAM_KEYS))
+    cursor_open.execute(command_dirs)
+    return _complete_sim_params(conn, dict(cursor_open.fetchall()), overrides)
+
+
+def get_status_tables(conn):
+    """returns the names of the default status table and of all status tables in the simulation parameters"""
+    cursor = conn.cursor()
+    cursor.execute("""SELECT DISTINCT param_value FROM public.simulation_parameters
+                      WHERE param_key = '%s'""" % SP.status)
+    return sorted(set([SP.OPTIONAL[SP.status]] + [row[0] for row in cursor.fetchall() if row[0]]))
+
+
+def get_all_sim_params(conn):
+    """returns the database parameters of all sim keys as a dict of dicts using a single query"""
+    cursor = conn.cursor()
+    cursor.execute("""SELECT sim_key, param_key, param_value FROM public.simulation_parameters
+                      WHERE param_key IN ('%s')""" % "','".join(PARAM_KEYS))
+    db_params = collections.defaultdict(dict)
+    for sim_key, key, value in cursor.fetchall():
+        db_params[sim_key][key] = value
+    return db_params
+
+
+def get_latest_status(conn, status_table, sim_keys):
+    """returns the msg_type of the latest status entry for every (sim_key, iteration) of the given sim keys"""
+    if not _cached(("status_table", status_table), lambda: database.table_exists(conn, status_table)):
+        raise AssertionError("Status table does not exist. Sim keys: %s" % ", ".join(sim_keys))
+    cursor = conn.cursor()
+    cursor.execute("""SELECT sim_key, iteration, msg_type FROM (
+                          SELECT sim_key, iteration, msg_type,
+                                 ROW_NUMBER() OVER (PARTITION BY sim_key, iteration ORDER BY status_time DESC) AS pos
+                          FROM public.%s WHERE sim_key IN ('%s')) latest
+                      WHERE pos = 1""" % (status_table, "','".join(sim_keys)))
+    return dict([((sim_key, int(iteration)), msg_type) for sim_key, iteration, msg_type in cursor.fetchall()])
+
+
 def get_active_sim_keys(server_options, overrides):
     sys.stdout.flush()
     conn = database.get_conn(server_options)
-    # get any open combination of sim_key and iteration
-    cursor_open = conn.cursor()
-    command = """SELECT sim_key, CAST(CAST(param_value AS FLOAT) AS INT) AS iteration FROM public.simulation_parameters
-                 WHERE param_key = '%s' ORDER BY sim_key, iteration""" % SP.max_iteration
-    cursor_open.execute(command)
-    max_iterations = dict(cursor_open.fetchall())
-
-    command = """SELECT sim_key, CAST(CAST(param_value AS FLOAT) AS INT) AS iteration FROM public.simulation_parameters
-                 WHERE param_key = '%s' ORDER BY sim_key, iteration""" % SP.iteration
-    cursor_open.execute(command)
     scenarios = getattr(server_options, "scenarios", None)
     if scenarios:
         scenarios = scenarios.split(",")
 
-    for sim_key, iteration in cursor_open.fetchall():
-        sim_params = get_sim_params(conn, sim_key, overrides)
+    # get any open combination of sim_key and iteration
+    candidates = []
+    for sim_key, db_params in sorted(get_all_sim_params(conn).items()):
+        if SP.iteration not in db_params or SP.max_iteration not in db_params:
+            continue
+        sim_params = _complete_sim_params(conn, db_params, overrides)
         if sim_params is None:
             continue
-        if iteration >= max_iterations[sim_key] and sim_params.get(SP.status) is not None:
+        iteration = int(float(db_params[SP.iteration]))
+        if iteration >= int(float(db_params[SP.max_iteration])) and sim_params.get(SP.status) is not None:
             continue
         if scenarios and sim_key not in scenarios and sim_params.get(SP.template) not in scenarios:
             continue
-        # check whether the iteration is or was already running
-        if sim_params.get(SP.status):
-            assert database.table_exists(conn, sim_params[SP.status]), ("Status table does not exist. Sim key: %s" % (sim_key))
-            command_status = "SELECT msg_type FROM public.%s WHERE sim_key = '%s' AND iteration = %s ORDER BY status_time DESC LIMIT 1" % (
-                sim_params[SP.status], sim_key, iteration)
-            cursor_open.execute(command_status)
-            status = cursor_open.fetchall()
-            if status and status[0][0] == "pending":
-                yield sim_key, iteration, sim_params
-        else:
+        candidates.append((sim_key, iteration, sim_params))
+
+    # check whether the iteration is or was already running, using one query per status table
+    status_tables = set([sim_params.get(SP.status) for _, _, sim_params in candidates])
+    latest = {}
+    for status_table in status_tables.difference([None, ""]):
+        latest.update(get_latest_status(conn, status_table, [c[0] for c in candidates if c[2].get(SP.status) == status_table]))
+    for sim_key, iteration, sim_params in candidates:
+        if not sim_params.get(SP.status) or latest.get((sim_key, iteration)) == "pending":
             yield sim_key, iteration, sim_params
     conn.close()
 
@@ -130,24 +188,68 @@ def fetch_chunks(cursor, arraysize=100000):
     rows = cursor.fetchmany()
     while rows:
         print("fetched %s rows" % len(rows))
-        for row in rows:
-            yield row
+        yield rows
         rows = cursor.fetchmany()
 
 
-def fetch_and_write(conn, command, tripfile, columns, mode="w"):
-    cursor = conn.cursor()
+def fetch_and_write(conn, command, tripfile, columns, mode="w", header=True):
+    if isinstance(conn, sqlite3.Connection):
+        # sqlite cursors step through the result lazily anyway
+        cursor = conn.cursor()
+    else:
+        # a named cursor keeps the result on the server instead of transferring it completely on execute
+        cursor = conn.cursor(name="fetch_trips")
     cursor.execute(command)
     num_rows = 0
     with open(tripfile, mode) as f:
-        print(",".join(columns), file=f)
-        for row in fetch_chunks(cursor):
-            num_rows += 1
-            print(','.join(["%.10g" % e if isinstance(e, float) else str(e) for e in row]), file=f)
+        if header:
+            print(",".join(columns), file=f)
+        for rows in fetch_chunks(cursor):
+            num_rows += len(rows)
+            f.write("".join([','.join(["%.10g" % e if isinstance(e, float) else str(e) for e in row]) + "\n"
+                             for row in rows]))
+    cursor.close()
     print("wrote %s rows to %s" % (num_rows, tripfile))
 
 
-def write_trips(conn, sim_key, limit, tripfile, params):
+def get_person_ranges(conn, trip_table, num_ranges):
+    """returns disjoint (lower, upper) p_id bounds of about equal size, upper inclusive only for the last one"""
+    fractions = ",".join([str(i / num_ranges) for i in range(num_ranges + 1)])
+    cursor = conn.cursor()
+    cursor.execute("SELECT percentile_disc(ARRAY[%s]) WITHIN GROUP (ORDER BY p_id) FROM public.%s" % (fractions, trip_table))
+    bounds = sorted(set([b for b in cursor.fetchone()[0] if b is not None]))
+    if len(bounds) < 2:
+        return [(b, b) for b in bounds]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fetch_ranges_and_write(conn_options, command, ranges, tripfile, columns):
+    """fetches the p_id ranges on parallel connections and concatenates the (sorted) parts in range order"""
+    parts = ["%s.part%s" % (tripfile, i) for i in range(len(ranges))]
+
+    def fetch(i):
+        lower, upper = ranges[i]
+        conn = database.get_conn(conn_options)
+        compare = "<=" if i == len(ranges) - 1 else "<"
+        fetch_and_write(conn, command.replace(PERSON_RANGE, "AND trips.p_id >= %s AND trips.p_id %s %s" % (lower, compare, upper)),
+                        parts[i], columns, header=False)
+        conn.close()
+
+    pool = ThreadPool(len(ranges))
+    try:
+        pool.map(fetch, range(len(ranges)))
+    finally:
+        pool.close()
+        pool.join()
+    with open(tripfile, "w") as f:
+        print(",".join(columns), file=f)
+        for part in parts:
+            with open(part) as inp:
+                shutil.copyfileobj(inp, f)
+            os.remove(part)
+
+
+def write_trips(conn, sim_key, limit, tripfile, params, conn_options=None):
     trip_table = "%s_%s" % (params[SP.trip_table_prefix], sim_key)
     taz_table = params[SP.taz_table]
     modes = params[SP.modes].replace(";", ",")
@@ -161,18 +263,26 @@ def write_trips(conn, sim_key, limit, tripfile, params):
         columns[fieldnames.index(TH.vtype)] = "cars.vtype_id AS %s" % TH.vtype
         command = """SELECT %s FROM public.%s trips, core.%s taz1, core.%s taz2, core.%s cars
                  WHERE trips.%s = taz1.taz_id AND trips.%s = taz2.taz_id AND mode in (%s) AND
-                       cars.car_key = '%s' AND cars.car_id = trips.car_type %s
+                       cars.car_key = '%s' AND cars.car_id = trips.car_type %s %s
                  ORDER BY p_id, hh_id, start_time_min
                  %s""" % (','.join(columns), trip_table, taz_table, taz_table, params[SP.car_table],
-                          TH.taz_id_start, TH.taz_id_end, modes, params[SP.car_fleet_key], params[SP.trip_filter], limit)
+                          TH.taz_id_start, TH.taz_id_end, modes, params[SP.car_fleet_key], params[SP.trip_filter],
+                          PERSON_RANGE, limit)
     else:
         # TODO fix vehicle type
         columns[fieldnames.index(TH.vtype)] = "'passenger' AS %s" % TH.vtype
         command = """SELECT %s FROM public.%s trips, core.%s taz1, core.%s taz2
-                     WHERE trips.%s = taz1.taz_id AND trips.%s = taz2.taz_id AND mode in (%s) %s
+                     WHERE trips.%s = taz1.taz_id AND trips.%s = taz2.taz_id AND mode in (%s) %s %s
                      ORDER BY p_id, hh_id, start_time_min
                      %s""" % (','.join(columns), trip_table, taz_table, taz_table,
-                              TH.taz_id_start, TH.taz_id_end, modes, params[SP.trip_filter], limit)
+                              TH.taz_id_start, TH.taz_id_end, modes, params[SP.trip_filter], PERSON_RANGE, limit)
+    connections = getattr(conn_options, "db_connections", 1)
+    if connections > 1 and not limit and not isinstance(conn, sqlite3.Connection):
+        ranges = get_person_ranges(conn, trip_table, connections)
+        if len(ranges) > 1:
+            fetch_ranges_and_write(conn_options, command, ranges, tripfile, fieldnames)
+            return command.replace(PERSON_RANGE, "")
+    command = command.replace(PERSON_RANGE, "")
     fetch_and_write(conn, command, tripfile, fieldnames)
     return command
 
@@ -276,7 +386,7 @@ def main():
             sim_keys = dict([(k, p) for k, _, p in get_active_sim_keys(options, {SP.status: None})])
             if options.simkey in sim_keys:
                 write_trips(conn, options.simkey, options.limit_sql,
-                            tripfile_name(options.simkey, options.limit), sim_keys[options.simkey])
+                            tripfile_name(options.simkey, options.limit), sim_keys[options.simkey], options)
             else:
                 print("Error: simkey '%s' not found. Available:\n%s" % (
                       options.simkey, list(sim_keys.keys())))
@@ -284,7 +394,7 @@ def main():
             # get all
             for sim_key, _, params in get_active_sim_keys(options, {}):
                 write_trips(conn, sim_key, options.limit_sql,
-                            tripfile_name(sim_key, options.limit), params)
+                            tripfile_name(sim_key, options.limit), params, options)
     conn.close()
 
 
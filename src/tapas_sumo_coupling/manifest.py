@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright (C) 2013-2025 German Aerospace Center (DLR) and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file    manifest.py
+# @author  agent
+# @date    2026-10-18
+
+# Stage manifests for --resume. After a stage finished, a manifest next to its
+# first output records a hash over the contents of its inputs and its relevant
+# parameters together with the size and modification time of its outputs.
+# A stage is skipped only if the recorded manifest matches exactly.
+
+from __future__ import print_function
+import os
+import json
+import hashlib
+
+from tapas_sumo_coupling import common
+
+SUFFIX = ".manifest.json"
+
+
+def _hash_input(digest, path):
+    if path is None or not os.path.exists(path):
+        digest.update(b"-\0")
+    elif os.path.isdir(path):
+        for f in sorted(os.listdir(path)):
+            digest.update(f.encode())
+            common.hash_file(digest, os.path.join(path, f))
+    else:
+        common.hash_file(digest, path)
+
+
+def _fingerprint(path):
+    if os.path.isdir(path):
+        return sorted([(f,) + _fingerprint(os.path.join(path, f)) for f in os.listdir(path)])
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def read_digest(path):
+    """returns the digest recorded in the given manifest or None if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f).get("digest")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Stage:
+    """a pipeline stage given by its output files, input files and parameters"""
+
+    def __init__(self, name, outputs, inputs=(), params=None, manifest=None):
+        self.name = name
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.manifest = manifest or self.outputs[0] + SUFFIX
+        self._digest = None
+
+    def digest(self):
+        if self._digest is None:
+            digest = hashlib.sha1(self.name.encode())
+            for path in self.inputs:
+                _hash_input(digest, path)
+            digest.update(json.dumps(self.params, sort_keys=True, default=str).encode())
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def _outputs_state(self):
+        return [json.loads(json.dumps(_fingerprint(o))) for o in self.outputs]
+
+    def is_current(self):
+        """returns whether all outputs exist and were created from the same inputs and parameters"""
+        if not os.path.exists(self.manifest) or not all([os.path.exists(o) for o in self.outputs]):
+            return False
+        try:
+            with open(self.manifest) as f:
+                recorded = json.load(f)
+        except ValueError:
+            return False
+        return recorded.get("digest") == self.digest() and recorded.get("outputs") == self._outputs_state()
+
+    def skip(self, resume):
+        """returns whether the stage can be skipped, printing a message if so"""
+        self._digest = None
+        if resume and self.is_current():
+            print("Skipping %s, the results in %s are up to date." % (self.name, ", ".join(self.outputs) or self.manifest))
+            return True
+        if resume and os.path.exists(self.manifest):
+            os.remove(self.manifest)
+        return False
+
+    def record(self, resume):
+        """writes the manifest after the stage finished successfully (only when resuming is enabled)"""
+        if resume and all([os.path.exists(o) for o in self.outputs]):
+            with open(self.manifest, "w") as f:
+                json.dump({"stage": self.name, "digest": self.digest(), "outputs": self._outputs_state()}, f)
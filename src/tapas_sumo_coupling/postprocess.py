@@ -28,7 +28,7 @@ sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
 import sumolib
 from sumolib.miscutils import benchmark, uMax
 
-from tapas_sumo_coupling.common import csv_sequence_generator, abspath_in_dir, build_uid
+from tapas_sumo_coupling.common import csv_sequence_generator, abspath_in_dir, build_uid, resolve_uid
 from tapas_sumo_coupling.constants import TH, THX, TAPAS_EXTRA_TIME, CAR_MODES, SP
 from tapas_sumo_coupling import database
 from tapas_sumo_coupling import emissions
@@ -45,7 +45,7 @@ def call(cmd):
 def parse_routes(routefile):
     result = {}
     for vehicle in sumolib.output.parse(routefile, "vehicle"):
-        result[vehicle.id] = (vehicle.route[0], vehicle.type)
+        result[resolve_uid(vehicle)] = (vehicle.route[0], vehicle.type)
     print('parsed %s routes from %s' % (len(result), routefile))
     return result
 
@@ -53,7 +53,9 @@ def parse_routes(routefile):
 def sorted_trip_sequence(tripfile):
     # sort by daytrip start
     persons = []
-    for pid, trip_sequence in csv_sequence_generator(tripfile, TH.person_id):
+    columns = (TH.person_id, TH.household_id, TH.depart_minute, TH.mode, TH.duration, TH.activity_duration_minutes,
+               THX.source_edge, THX.dest_edge, THX.depart_second, THX.departpos, THX.arrivalpos)
+    for pid, trip_sequence in csv_sequence_generator(tripfile, TH.person_id, columns=columns):
         first_row = trip_sequence[0]
         depart = int(first_row[TH.depart_minute])
         persons.append((depart, pid, trip_sequence))
@@ -226,8 +228,9 @@ def run_emission_sumo(options, params, conn, routefile, emission_model="HBEFA3",
     with open(mod_routes_file, 'w') as f:
         f.write('<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">\n')
         for vehicle in sumolib.output.parse(routefile, "vehicle"):
-            if vehicle.id in vtype: # this will skip the clones
-                vehicle.type = vtype[vehicle.id]
+            uid = resolve_uid(vehicle)
+            if uid in vtype: # this will skip the clones
+                vehicle.type = vtype[uid]
                 f.write(vehicle.toXML("    "))
         f.write('</routes>\n')
 
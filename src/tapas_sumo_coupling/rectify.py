@@ -0,0 +1,387 @@
+# Copyright (C) 2013-2025 German Aerospace Center (DLR) and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file    rectify.py
+# @author  agent
+# @date    2026-10-18
+
+# clean up tapas trips working on batches of persons as numpy arrays
+
+from __future__ import print_function, division
+import os
+import sys
+import multiprocessing
+
+import numpy as np
+
+if 'SUMO_HOME' in os.environ:
+    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
+    sys.path.append(tools)
+else:
+    sys.exit("please declare environment variable 'SUMO_HOME'")
+
+import sumolib
+from sumolib.miscutils import euclidean
+
+from tapas_sumo_coupling.constants import TH, THX, TAPAS_DAY_OVERLAP_MINUTES
+from tapas_sumo_coupling.common import TripTable, MappingError, person_random
+from tapas_sumo_coupling import columnar
+
+
+class BatchResult:
+    """rows, messages and counters of a single batch of rectified persons"""
+
+    def __init__(self):
+        self.rows = []
+        self.messages = []
+        self.persons = 0
+        self.trips = 0
+        self.gaps = []  # (length, uid) in input order
+        self.inconsistent = 0
+        self.skipped_wrong_mode = 0
+        self.skipped_wrong_depart = 0
+        self.max_depart = (0, None)
+
+
+class Rectifier:
+
+    def __init__(self, options, table):
+        self.options = options
+        self.table = table
+        self.depart_minute = table.converted(TH.depart_minute, int, np.int64)
+        self.duration = table.converted(TH.duration, float, np.float64)
+        self.activity_duration = table.converted(TH.activity_duration_minutes, int, np.int64) * 60
+        modes = options.modes.split(",")
+        self.mode_ok = table.converted(TH.mode, lambda m: m in modes, bool)
+        # the projection is done once for every distinct location
+        lon = np.array([float(loc[0]) for loc in table.locations])
+        lat = np.array([float(loc[1]) for loc in table.locations])
+        if len(table.locations) > 0:
+            self.x, self.y = options.net.convertLonLat2XY(lon, lat)
+        else:
+            self.x, self.y = lon, lat
+        self.init_sigma, self.dest_sigma = self._get_diffusion()
+
+    def _get_diffusion(self):
+        """computes for every location the standard deviation of the spatial diffusion
+           when starting a trip chain there and when arriving there (nan meaning no diffusion)"""
+        options = self.options
+        sigma = np.full(len(self.table.locations), np.nan)
+        if options.max_spatial_diffusion > 0 and self.table.num_rows > 0:
+            count = np.bincount(self.table.source[self.mode_ok], minlength=len(sigma))
+            count += np.bincount(self.table.dest[self.mode_ok], minlength=len(sigma))
+            lower, upper = options.spatial_diffusion_bounds
+            scale = (count - lower).astype(np.float64) / (upper - lower)
+            diffusion = scale * (options.max_spatial_diffusion - options.spatial_diffusion) + options.spatial_diffusion
+            use = (count >= lower) & (diffusion < options.max_spatial_diffusion)
+            sigma[use] = diffusion[use]
+        if os.path.exists(options.location_priority_file):
+            for loc in sumolib.xml.parse(options.location_priority_file, "poi"):
+                if (loc.lon, loc.lat) in self.table.location_index:
+                    sigma[self.table.location_index[(loc.lon, loc.lat)]] = 0
+        init_sigma = sigma.copy()
+        if options.max_spatial_diffusion <= 0 and options.spatial_diffusion > 0:
+            init_sigma[np.isnan(init_sigma)] = options.spatial_diffusion
+        return init_sigma, np.where(np.isnan(sigma), options.spatial_diffusion, sigma)
+
+    def uid(self, row):
+        return '%s_%s_%s_0' % (self.table.get(TH.person_id, row), self.table.get(TH.household_id, row),
+                               self.depart_minute[row])
+
+    def person_random(self, row):
+        return person_random(self.options.seed, self.table.get(TH.person_id, row),
+                             self.table.get(TH.household_id, row), "rectify")
+
+    def _draw(self, rngs, starts, init_rows, init_sigma, dest_rows, dest_sigma):
+        """Draws the time smoothing for every person and the diffusion offsets
+           in the same order as the row wise processing would do it, using the
+           random stream of the respective person.
+           Returns the smoothing and the offset pairs sorted by row."""
+        rows = np.concatenate((starts, init_rows, dest_rows))
+        kind = np.concatenate((np.zeros(len(starts), np.int64), np.ones(len(init_rows), np.int64),
+                               np.full(len(dest_rows), 2, np.int64)))
+        order = np.argsort(rows * 3 + kind, kind="stable")
+        sigma = np.concatenate((np.full(len(starts), np.nan), init_sigma, dest_sigma))[order]
+        persons = iter(rngs)
+        draws = []
+        for s in sigma.tolist():
+            if s != s:
+                # the smoothing is the first draw of each person
+                rng = next(persons)
+                draws.append(rng.random())
+            else:
+                draws.append(rng.gauss(0, s))
+                draws.append(rng.gauss(0, s))
+        draws = np.array(draws)
+        count = np.where(np.isnan(sigma), 1, 2)
+        pos = np.cumsum(count) - count
+        is_offset = kind[order] > 0
+        offset_pos = pos[is_offset]
+        return draws[pos[~is_offset]], rows[order][is_offset], draws[offset_pos], draws[offset_pos + 1]
+
+    def rectify_batch(self, first, last):
+        """rectifies the persons with index first (inclusive) to last (exclusive)"""
+        options = self.options
+        t = self.table
+        result = BatchResult()
+        r0 = t.person_starts[first]
+        r1 = t.person_starts[last]
+        starts = t.person_starts[first:last] - r0
+        lengths = np.diff(t.person_starts[first:last + 1])
+        num = last - first
+        result.persons = num
+        result.trips = r1 - r0
+        if num == 0:
+            return result
+        depart_minute = self.depart_minute[r0:r1]
+        wrong_day = (depart_minute - 24 * 60 >= TAPAS_DAY_OVERLAP_MINUTES) | (depart_minute <= -TAPAS_DAY_OVERLAP_MINUTES)
+        source = t.source[r0:r1]
+        dest = t.dest[r0:r1]
+        sx, sy = self.x[source], self.y[source]
+        dx, dy = self.x[dest], self.y[dest]
+
+        # find trips following gaps and the trips needing random diffusion offsets,
+        # processing the n-th trip of all persons at once
+        accepted = np.zeros(r1 - r0, bool)
+        has_init = np.zeros(r1 - r0, bool)
+        diffuse = np.zeros(r1 - r0, bool)
+        has_offset = np.zeros(num, bool)
+        has_dest = np.zeros(num, bool)
+        dest_x = np.zeros(num)
+        dest_y = np.zeros(num)
+        gap_rows = []
+        gap_from = []
+        for pos in range(lengths.max()):
+            active = np.flatnonzero(lengths > pos)
+            r = starts[active] + pos
+            init = ~has_offset[active] & ~np.isnan(self.init_sigma[source[r]])
+            has_init[r[init]] = True
+            has_offset[active[init]] = True
+            valid = ~wrong_day[r]
+            active = active[valid]
+            r = r[valid]
+            if options.ignore_gaps:
+                gap = np.zeros(len(r), bool)
+            else:
+                gap = has_dest[active] & ((dest_x[active] != sx[r]) | (dest_y[active] != sy[r]))
+                gap_rows.append(r[gap])
+                gap_from.append((dest_x[active[gap]], dest_y[active[gap]]))
+            active = active[~gap]
+            r = r[~gap]
+            accepted[r] = True
+            has_dest[active] = True
+            dest_x[active] = dx[r]
+            dest_y[active] = dy[r]
+            diffuse[r[has_offset[active]]] = True
+
+        init_rows = np.flatnonzero(has_init)
+        dest_rows = np.flatnonzero(diffuse)
+        rngs = [self.person_random(r0 + s) for s in starts.tolist()]
+        smoothing, offset_rows, offset_x, offset_y = self._draw(
+            rngs, starts, init_rows, self.init_sigma[source[init_rows]], dest_rows, self.dest_sigma[dest[dest_rows]])
+        smoothing = (smoothing * (options.time_diffusion + 1)).astype(np.int64) - options.time_diffusion // 2
+
+        # repair overlapping trips
+        depart = depart_minute * 60 + np.repeat(smoothing, lengths)
+        duration = self.duration[r0:r1]
+        nan_duration = np.isnan(duration) & ~wrong_day
+        duration = np.where(nan_duration, 1., duration)
+        activity_duration = self.activity_duration[r0:r1]
+        inconsistent = np.zeros(r1 - r0, np.int64)
+        previous_end = np.zeros(num, np.int64)
+        previous_depart = np.zeros(num, np.int64)
+        has_previous = np.zeros(num, bool)
+        unordered = []
+        for pos in range(lengths.max()):
+            active = np.flatnonzero(lengths > pos)
+            r = starts[active] + pos
+            valid = ~wrong_day[r]
+            active = active[valid]
+            r = r[valid]
+            d = depart[r]
+            late = has_previous[active] & (d < previous_end[active])
+            diff = previous_end[active] - d
+            inconsistent[r[late & (diff >= 60)]] = diff[late & (diff >= 60)]
+            d = np.where(late, previous_end[active], d)
+            previous_end[active] = (d + duration[r] + activity_duration[r]).astype(np.int64)
+            unordered.append(r[has_previous[active] & (d < previous_depart[active])])
+            previous_depart[active] = d
+            has_previous[active] = True
+        unordered = np.concatenate(unordered)
+        if len(unordered) > 0:
+            row = r0 + unordered.min()
+            raise MappingError('Unordered trips for person %s at departure %s' % (
+                t.get(TH.person_id, row), self.depart_minute[row]))
+
+        # collect warnings and statistics
+        for r in np.flatnonzero(wrong_day | nan_duration | (inconsistent > 0)).tolist():
+            uid = self.uid(r0 + r)
+            if wrong_day[r]:
+                result.messages.append("Warning: dropping trip %s because it starts on the wrong day (minute %s)" % (
+                                       uid, depart_minute[r]))
+                continue
+            if nan_duration[r]:
+                result.messages.append('Warning: NaN value in duration of trip %s' % uid)
+            if inconsistent[r] > 0:
+                result.messages.append("Warning: inconsistent depart time for trip %s (%s seconds)" %
+                                       (uid, inconsistent[r]))
+        result.inconsistent = int(np.count_nonzero(inconsistent))
+        result.skipped_wrong_depart = int(np.count_nonzero(wrong_day))
+        if result.skipped_wrong_depart > 0:
+            max_depart = depart_minute[wrong_day].max()
+            if max_depart > 0:
+                r = np.flatnonzero(wrong_day & (depart_minute == max_depart))[0]
+                result.max_depart = (int(max_depart), self.uid(r0 + r))
+        if gap_rows:
+            gap_rows = np.concatenate(gap_rows)
+            gap_x = np.concatenate([g[0] for g in gap_from])
+            gap_y = np.concatenate([g[1] for g in gap_from])
+            order = np.argsort(gap_rows)
+            for r, x, y in zip(gap_rows[order].tolist(), gap_x[order].tolist(), gap_y[order].tolist()):
+                result.gaps.append((euclidean((x, y), (float(sx[r]), float(sy[r]))), self.uid(r0 + r)))
+        written = accepted & self.mode_ok[r0:r1]
+        result.skipped_wrong_mode = int(np.count_nonzero(accepted & ~written))
+
+        # apply the spatial diffusion, the source of each trip uses the previously drawn offset
+        offset_index = np.searchsorted(offset_rows, dest_rows, side="right") - 1
+        source_lon, source_lat = self._unproject(sx[dest_rows] + offset_x[offset_index - 1],
+                                                 sy[dest_rows] + offset_y[offset_index - 1])
+        dest_lon, dest_lat = self._unproject(dx[dest_rows] + offset_x[offset_index],
+                                             dy[dest_rows] + offset_y[offset_index])
+
+        # build output rows
+        rows = np.flatnonzero(written)
+        global_rows = rows + r0
+        columns = []
+        for field in THX.fieldnames:
+            if field == THX.depart_second:
+                columns.append(depart[rows].tolist())
+            elif field == TH.duration:
+                column = t.column(field, global_rows)
+                for i in np.flatnonzero(nan_duration[rows]).tolist():
+                    column[i] = 1
+                columns.append(column)
+            elif field in (TH.source_long, TH.source_lat, TH.dest_long, TH.dest_lat):
+                is_source = field in (TH.source_long, TH.source_lat)
+                coord = 0 if field in (TH.source_long, TH.dest_long) else 1
+                column = t.location_column(source[rows] if is_source else dest[rows], coord)
+                if is_source:
+                    diffused = source_lon if coord == 0 else source_lat
+                else:
+                    diffused = dest_lon if coord == 0 else dest_lat
+                for i, v in zip(np.searchsorted(rows, dest_rows[written[dest_rows]]).tolist(),
+                                diffused[written[dest_rows]].tolist()):
+                    column[i] = v
+                columns.append(column)
+            else:
+                column = t.column(field, global_rows)
+                columns.append(column)
+        result.rows = list(zip(*columns))
+        return result
+
+    def _unproject(self, x, y):
+        if len(x) == 0:
+            return x, y
+        return self.options.net.convertXY2LonLat(x, y)
+
+
+_rectifier = None
+
+
+def init(rectifier):
+    global _rectifier
+    _rectifier = rectifier
+
+
+def rectify_batch(first_last):
+    return _rectifier.rectify_batch(*first_last)
+
+
+def get_batches(selected, batch_size):
+    """splits the sorted person indices into ranges of consecutive persons of at most batch_size"""
+    batches = []
+    for run in np.split(selected, np.flatnonzero(np.diff(selected) != 1) + 1):
+        if len(run) > 0:
+            end = int(run[-1]) + 1
+            batches += [(first, min(first + batch_size, end)) for first in range(int(run[0]), end, batch_size)]
+    return batches
+
+
+def rectify_trips(options, log, person_keys=None):
+    """reads the tapas trips once and writes the rectified trips in batches
+       (in parallel if options.processes > 1), restricted to the given
+       (person_id, household_id) keys if person_keys is not None"""
+    table = TripTable(options.tapas_trips)
+    init(Rectifier(options, table))
+    persons = 0
+    rows = 0
+    gaps = 0
+    gap_sum = 0
+    max_gap = 0
+    max_gap_uid = None
+    max_depart = 0
+    max_depart_uid = None
+    inconsistent = 0
+    skipped_wrong_mode = 0
+    skipped_wrong_depart = 0
+    selected = np.arange(len(table.person_starts) - 1)
+    if person_keys is not None:
+        # the diffusion still depends on all locations of the input, only the batches are restricted
+        starts = table.person_starts[:-1]
+        selected = selected[np.array([key in person_keys for key in zip(table.column(TH.person_id, starts),
+                                                                    table.column(TH.household_id, starts))], bool)]
+    batches = get_batches(selected, options.rectify_batch_size)
+    pool = None
+    if options.processes > 1 and len(batches) > 1:
+        # the workers inherit the table when forking, every person has its
+        # own random stream so the result does not depend on the distribution
+        pool = multiprocessing.Pool(min(options.processes, len(batches)), init, (_rectifier,))
+        results = pool.imap(rectify_batch, batches)
+    else:
+        results = map(rectify_batch, batches)
+    try:
+        with columnar.open_writer(options.rectified, THX.fieldnames, '\n') as writer:
+            for result in results:
+                for msg in result.messages:
+                    log(msg)
+                writer.writetuples(result.rows)
+                persons += result.persons
+                rows += result.trips
+                for gap, uid in result.gaps:
+                    gaps += 1
+                    gap_sum += gap
+                    max_gap = max(max_gap, gap)
+                    max_gap_uid = uid
+                inconsistent += result.inconsistent
+                skipped_wrong_mode += result.skipped_wrong_mode
+                skipped_wrong_depart += result.skipped_wrong_depart
+                if result.max_depart[0] > max_depart:
+                    max_depart, max_depart_uid = result.max_depart
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            # all results were consumed unless a batch failed
+            pool.terminate()
+            pool.join()
+
+    log('Read %s persons with a total of %s trips from input file "%s".' %
+        (persons, rows, options.tapas_trips))
+    if skipped_wrong_mode > 0:
+        log('Dropped %s trips because they have the wrong mode' %
+            skipped_wrong_mode)
+    log('%s trips have inconsistent depart times.' % inconsistent)
+    if gaps > 0:
+        log('Dropped %s trips because of gaps, avg: %s, maximum: %s (for trip %s).' %
+            (gaps, gap_sum / gaps, max_gap, max_gap_uid))
+    if skipped_wrong_depart > 0:
+        log('Dropped %d trips because they start on the wrong day (maximum: %s for trip %s).' %
+            (skipped_wrong_depart, max_depart, max_depart_uid))
@@ -22,6 +22,8 @@ from __future__ import print_function, division
 import os
 import sys
 import collections
+import array
+import numpy as np
 
 if 'SUMO_HOME' in os.environ:
     tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -30,19 +32,19 @@ else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
 import sumolib
-from sumolib import output
 from sumolib.miscutils import Statistics, benchmark
 from sumolib.net import readNet
 from sumolib.options import ArgumentParser
 
-from tapas_sumo_coupling.common import parseTaz
+from tapas_sumo_coupling.common import parseTaz, parse_uid, resolve_uid
 from tapas_sumo_coupling.constants import SP, BACKGROUND_TRAFFIC_SUFFIX
 from tapas_sumo_coupling import database
 from tapas_sumo_coupling import s2t_pt
+from tapas_sumo_coupling import simoutput
 
 
 @benchmark
-def aggregate_weights(weights_in, timeline, out_file=None):
+def aggregate_weights(weights_in, timeline, out_file=None, processes=1):
     if out_file is None:
         out_file = weights_in[:-4] + '_aggregated.xml'
     elif not os.path.isdir(os.path.dirname(out_file)):
@@ -63,7 +65,7 @@ def aggregate_weights(weights_in, timeline, out_file=None):
                     '        <edge id="%s" traveltime="%s"/>\n' % (e, samples[e] / travel_time_ratios[e]))
 
         begin = 24 * 3600
-        for interval in output.parse(weights_in, ['interval']):
+        for interval in simoutput.parse(weights_in, 'interval', ('edge',), processes):
             if interval.edge is not None:
                 for edge in interval.edge:
                     if edge.traveltime is not None:
@@ -86,36 +88,137 @@ def aggregate_weights(weights_in, timeline, out_file=None):
     return out_file
 
 
-@benchmark
-def _parse_vehicle_info(routes):
-    sumoTime = Statistics("SUMO durations")
-    sumoDist = Statistics("SUMO distances")
-    stats = []
-    for v in output.parse(routes, ('vehicle', 'person')):
-        if not v.line and not v.id.endswith(BACKGROUND_TRAFFIC_SUFFIX) and v.depart != "triggered":
-            duration = float(v.arrival) - float(v.depart)
-            length = float(v.routeLength) if v.routeLength else 0
-            sumoTime.add(duration, v.id)
-            sumoDist.add(length, v.id)
-            dataTuple = tuple(v.id.split('_'))
+def _raw_taz(vehicle):
+    """returns the unconverted taz pair, see common.parseTaz"""
+    fromTaz, toTaz = vehicle.fromTaz, vehicle.toTaz
+    if vehicle.param is not None:
+        for p in vehicle.param:
+            if p.key == "taz_id_start":
+                fromTaz = p.value
+            if p.key == "taz_id_end":
+                toTaz = p.value
+    return fromTaz, toTaz
+
+
+def _taz_or_missing(value):
+    return -1 if value is None else int(value)
+
+
+class RouteIndex:
+    """Compact records of all vehicles and persons of a vehroute file, collected in a single pass.
+    The trip upload and all the all pair uploads (for every vType and slice) query this index
+    instead of parsing the file again. Vehicle records are kept in typed arrays per vehicle type
+    sorted by departure, so every time slice is a contiguous range."""
+
+    def __init__(self, routes, processes=1):
+        self.routes = routes
+        self.group_uids = {}
+        self._trip_ids = []
+        self._trip_durations = array.array('d')
+        self._trip_lengths = array.array('d')
+        self._person_data = {}
+        self._persons = []
+        self._vehicles = {}
+        if os.path.isfile(routes):
+            self._parse(processes)
+
+    @benchmark
+    def _parse(self, processes):
+        columns = collections.defaultdict(lambda: (array.array('d'), array.array('q'), array.array('q'),
+                                                   array.array('d'), array.array('d')))
+        for v in simoutput.parse(self.routes, ('vehicle', 'person'), processes=processes):
+            uid = resolve_uid(v)
+            if uid != v.id:
+                self.group_uids[v.id] = uid
+            background = uid.endswith(BACKGROUND_TRAFFIC_SUFFIX)
+            if not v.line and not background and v.depart != "triggered":
+                if v.name == "person":
+                    self._person_data[len(self._trip_ids)] = s2t_pt.parse_person(v)
+                self._trip_ids.append(uid)
+                self._trip_durations.append(float(v.arrival) - float(v.depart))
+                self._trip_lengths.append(float(v.routeLength) if v.routeLength else 0)
             if v.name == "vehicle":
-                dataTuple += ((0, 0, duration), (0, 0, length))
+                if not background and v.depart != "triggered" and v.type is not None:
+                    fromTaz, toTaz = _raw_taz(v)
+                    for column, value in zip(columns[v.type], (float(v.depart) % (24 * 3600), _taz_or_missing(fromTaz),
+                                                               _taz_or_missing(toTaz), float(v.arrival) - float(v.depart),
+                                                               float(v.routeLength) if v.routeLength else 0)):
+                        column.append(value)
+            elif not v.id.endswith(BACKGROUND_TRAFFIC_SUFFIX):
+                if v.arrival is None:
+                    self._persons.append(v.id)
+                else:
+                    # a missing taz only matters for the all pair upload, see person_taz_stats
+                    fromTaz, toTaz = _raw_taz(v)
+                    self._persons.append((v.id, _taz_or_missing(fromTaz), _taz_or_missing(toTaz)) +
+                                         s2t_pt.parse_person(v))
+        for vType, typeColumns in columns.items():
+            departs = np.frombuffer(typeColumns[0], dtype=np.float64)
+            order = np.argsort(departs, kind="stable")
+            self._vehicles[vType] = [np.frombuffer(c, dtype=np.float64 if c.typecode == 'd' else np.int64)[order]
+                                     for c in typeColumns]
+
+    def trip_stats(self):
+        """returns the data of all trips for the trip result upload"""
+        sumoTime = Statistics("SUMO durations")
+        sumoDist = Statistics("SUMO distances")
+        stats = []
+        for idx, (uid, duration, length) in enumerate(zip(self._trip_ids, self._trip_durations, self._trip_lengths)):
+            sumoTime.add(duration, uid)
+            sumoDist.add(length, uid)
+            data = self._person_data.get(idx)
+            if data is None:
+                data = ((0, 0, duration), (0, 0, length))
+            stats.append(parse_uid(uid) + data)
+        print("Parsed results for %s vehicles and persons" % len(stats))
+        print(sumoTime)
+        print(sumoDist)
+        return stats
+
+    def vehicle_taz_stats(self, start, end, vType):
+        """returns taz pair, travel time and length of the vehicles with a type starting with vType
+           which depart (modulo one day) in [start, end)"""
+        stats = []
+        for t, (departs, fromTaz, toTaz, durations, lengths) in self._vehicles.items():
+            # vType is something like "passenger" and t "passenger_PHEMlight/PC_G_EU3"
+            if t.startswith(vType):
+                lo, hi = np.searchsorted(departs, (start, end))
+                if (fromTaz[lo:hi] < 0).any() or (toTaz[lo:hi] < 0).any():
+                    raise ValueError("Missing taz information for vehicles of type '%s'." % t)
+                stats.extend(zip(fromTaz[lo:hi].tolist(), toTaz[lo:hi].tolist(), [0] * (hi - lo),
+                                 durations[lo:hi].tolist(), lengths[lo:hi].tolist()))
+        return stats
+
+    def person_taz_stats(self):
+        """yields taz pair, the all pairs flag (always False), travel times and lengths of the completed persons"""
+        for record in self._persons:
+            if isinstance(record, tuple):
+                if record[1] < 0 or record[2] < 0:
+                    raise ValueError("Missing taz information for person '%s'." % record[0])
+                yield record[1:3] + (False,) + record[3:]
             else:
-                dataTuple += s2t_pt.parse_person(v)
-            stats.append(dataTuple)
-    print("Parsed results for %s vehicles and persons" % len(stats))
-    print(sumoTime)
-    print(sumoDist)
-    return stats
+                print("Ignoring incomplete trip for person '%s'!" % record)
+
+
+def get_route_index(routes, processes=1):
+    return routes if isinstance(routes, RouteIndex) else RouteIndex(routes, processes)
+
+
+@benchmark
+def _parse_vehicle_info(routes, group_uids=None):
+    index = get_route_index(routes)
+    if group_uids is not None:
+        group_uids.update(index.group_uids)
+    return index.trip_stats()
 
 
 @benchmark
-def _parse_vehicle_emissions(tripinfos):
+def _parse_vehicle_emissions(tripinfos, group_uids=None, processes=1):
     electric = Statistics("Electric")
     fuel = Statistics("Fuel")
     energy = {}
     emissions = {}
-    for v in output.parse(tripinfos, 'tripinfo'):
+    for v in simoutput.parse(tripinfos, 'tripinfo', simoutput.TRIPINFO_CHILDREN, processes):
         if not v.line and not v.id.endswith(BACKGROUND_TRAFFIC_SUFFIX) and v.depart != "triggered":
             em = v.emissions[0]
             # SUMO returns Wh, we want MJ
@@ -128,8 +231,9 @@ def _parse_vehicle_emissions(tripinfos):
                        float(em.PMx_abs) * 1e-3, float(em.NOx_abs) * 1e-3])
             electric.add(e, v.id)
             fuel.add(f, v.id)
-            energy[tuple(v.id.split('_'))] = (e, f)
-            emissions[tuple(v.id.split('_'))] = c
+            uid = parse_uid(group_uids.get(v.id, v.id) if group_uids else v.id)
+            energy[uid] = (e, f)
+            emissions[uid] = c
     print("Parsed emission results for %s vehicles:" % len(energy))
     print(electric)
     print(fuel)
@@ -138,27 +242,23 @@ def _parse_vehicle_emissions(tripinfos):
 
 @benchmark
 def _parse_vehicle_info_taz(routes, start, end, vType):
-    stats = []
-    if os.path.isfile(routes):
-        for v in output.parse(routes, 'vehicle'):
-            if not v.id.endswith(BACKGROUND_TRAFFIC_SUFFIX) and v.depart != "triggered":
-                depart = float(v.depart) % (24 * 3600)
-                # vType is something like "passenger" and v.type "passenger_PHEMlight/PC_G_EU3"
-                if depart >= start and depart < end and v.type is not None and v.type.startswith(vType):
-                    stats.append(parseTaz(v) + (0, float(v.arrival) - float(v.depart), float(v.routeLength)))
+    stats = get_route_index(routes).vehicle_taz_stats(start, end, vType)
     print("Parsed taz results for %s vehicles" % len(stats))
     return stats
 
 
 @benchmark
-def upload_trip_results(conn, key, params, routes, trip_emissions=None, limit=None):
-    tripstats = _parse_vehicle_info(routes)
+def upload_trip_results(conn, key, params, routes, trip_emissions=None, limit=None, processes=1, options=None):
+    routes = get_route_index(routes, processes)
+    group_uids = {}
+    tripstats = _parse_vehicle_info(routes, group_uids)
     columns = "p_id, hh_id, start_time_min, clone_id, travel_time_sec, distance_real"
     emission_column_def = ""
     if trip_emissions:
         columns += ", energy_MJ, emission_g"
         emission_column_def = "energy_MJ double precision[], emission_g double precision[],"
-        energy, emissions = _parse_vehicle_emissions(os.path.join(os.path.dirname(routes), trip_emissions))
+        energy, emissions = _parse_vehicle_emissions(os.path.join(os.path.dirname(routes.routes), trip_emissions),
+                                                     group_uids, processes)
         tripstats = [t + (energy[t[:-2]], emissions[t[:-2]]) for t in tripstats[:limit]]
     table = '%s_%s' % (params[SP.trip_output], key)
     if conn is None:
@@ -179,9 +279,13 @@ CREATE TABLE %%s
   CONSTRAINT %%s_pkey PRIMARY KEY (p_id, hh_id, start_time_min, clone_id)
 )
 """ % emission_column_def
-        schema_table = database.create_table(conn, 'temp', table, createQuery)
-        values = [tuple([str(e).replace("(", "{").replace(")", "}") for e in t]) for t in tripstats[:limit]]
-        database.insertmany(conn, schema_table, columns, values)
+        schema_table = database.create_table(conn, 'temp', table, createQuery, staging=True)
+        try:
+            database.insertmany(conn, schema_table, columns, tripstats[:limit], options)
+            database.finish_table(conn, schema_table)
+        except BaseException:
+            database.abort_table(conn, schema_table)
+            raise
 
 
 @benchmark
@@ -212,7 +316,7 @@ def _createValueTuple(od, vType, end, real, sumoTime, sumoDist):
 
 
 @benchmark
-def upload_all_pairs(conn, tables, start, end, vType, real_routes, rep_routes, net, startIdx=0):
+def upload_all_pairs(conn, tables, start, end, vType, real_routes, rep_routes, net, startIdx=0, options=None):
     stats = _parse_vehicle_info_taz(real_routes, start, end, vType)
     if rep_routes:
         stats.extend(_get_all_pair_stats(rep_routes, net))
@@ -244,10 +348,14 @@ def upload_all_pairs(conn, tables, start, end, vType, real_routes, rep_routes, n
     for idx, v in enumerate(values):
         odValues.append(v[:4] + (startIdx + idx,))
         entryValues.append(v[4:] + (startIdx + idx, "{car}"))
-    database.insertmany(conn, tables[0], "taz_id_start, taz_id_end, sumo_type, interval_end, entry_id", odValues)
     columns = """realtrip_count, representative_count, travel_time_sec, travel_time_stddev,
                  distance_real, distance_stddev, entry_id, used_modes"""
-    database.insertmany(conn, tables[1], columns, entryValues)
+    try:
+        database.insertmany(conn, tables[0], "taz_id_start, taz_id_end, sumo_type, interval_end, entry_id", odValues, options)
+        database.insertmany(conn, tables[1], columns, entryValues, options)
+    except BaseException:
+        abort_all_pairs(conn, tables)
+        raise
     return startIdx + len(values)
 
 
@@ -265,7 +373,7 @@ CREATE TABLE %s
   CONSTRAINT %s_pkey PRIMARY KEY (taz_id_start, taz_id_end, sumo_type, is_restricted, interval_end)
 )
 """
-    schema_table = database.create_table(conn, 'temp', '%s_%s' % (params[SP.od_output], key), createQuery)
+    schema_table = database.create_table(conn, 'temp', '%s_%s' % (params[SP.od_output], key), createQuery, staging=True)
     createQuery = """
 CREATE TABLE %s
 (
@@ -280,10 +388,22 @@ CREATE TABLE %s
   CONSTRAINT %s_pkey PRIMARY KEY (entry_id, used_modes)
 )
 """
-    entry_schema_table = database.create_table(conn, 'temp', '%s_%s' % (params[SP.od_entry], key), createQuery)
+    entry_schema_table = database.create_table(conn, 'temp', '%s_%s' % (params[SP.od_entry], key), createQuery,
+                                               staging=True)
     return schema_table, entry_schema_table
 
 
+def finish_all_pairs(conn, tables):
+    """builds the primary keys and moves the all pairs tables into place after all uploads"""
+    return tuple([database.finish_table(conn, t) for t in tables])
+
+
+def abort_all_pairs(conn, tables):
+    """drops the all pairs tables after a failed upload"""
+    for t in tables:
+        database.abort_table(conn, t)
+
+
 @benchmark
 def main():
     argParser = ArgumentParser()
@@ -298,20 +418,24 @@ def main():
                            help="set the route file to read representative travel times from")
     argParser.add_argument("--real-trips", default="",
                            help="set the route file to read travel times for real trips from")
+    argParser.add_argument("--processes", type=int, default=1,
+                           help="number of processes for parsing large uncompressed outputs")
     argParser.add_argument("-a", "--all-pairs",
                            default=False, action="store_true",
                            help="Only write the all pairs table")
     options, args = argParser.parse_known_args()
     if len(args) == 2:
-        aggregate_weights(args[0], [float(x) for x in args[1].split(",")])
+        aggregate_weights(args[0], [float(x) for x in args[1].split(",")], processes=options.processes)
         return
     conn = database.get_conn(options)
     if os.path.isfile(options.real_trips) and not options.all_pairs:
-        upload_trip_results(conn, options.simkey, SP.OPTIONAL, options.real_trips, limit=options.limit)
+        upload_trip_results(conn, options.simkey, SP.OPTIONAL, options.real_trips, limit=options.limit,
+                            processes=options.processes, options=options)
     if os.path.isfile(options.representatives):
         tables = create_all_pairs(conn, options.simkey, SP.OPTIONAL)
         upload_all_pairs(conn, tables, 0, 86400, "passenger", options.real_trips,
-                         options.representatives, readNet(options.net_file))
+                         options.representatives, readNet(options.net_file), options=options)
+        finish_all_pairs(conn, tables)
     if conn:
         conn.close()
 
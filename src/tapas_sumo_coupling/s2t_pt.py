@@ -28,12 +28,11 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
-from sumolib import output
 from sumolib.miscutils import Statistics, benchmark
 
 from tapas_sumo_coupling.common import parseTaz
-from tapas_sumo_coupling.constants import BACKGROUND_TRAFFIC_SUFFIX
 from tapas_sumo_coupling import database
+from tapas_sumo_coupling import simoutput
 
 
 def parse_person(p):
@@ -79,13 +78,9 @@ def parse_person(p):
 
 @benchmark
 def _parse_person_info_taz(routes, start, end):
-    if os.path.isfile(routes):
-        for p in output.parse(routes, 'person'):
-            if not p.id.endswith(BACKGROUND_TRAFFIC_SUFFIX):
-                if p.arrival is None:
-                    print("Ignoring incomplete trip for person '%s'!" % p.id)
-                else:
-                    yield parseTaz(p) + (False,) + parse_person(p)
+    from tapas_sumo_coupling import s2t_miv  # s2t_miv imports this module
+    for record in s2t_miv.get_route_index(routes).person_taz_stats():
+        yield record
 
 
 @benchmark
@@ -93,7 +88,7 @@ def _get_all_pair_stats(rou_file, net):
     """Parses a duarouter .rou.xml output for persons"""
     sumoTime = Statistics("SUMO durations")
     sumoDist = Statistics("SUMO distances")
-    for p in output.parse(rou_file, 'person'):
+    for p in simoutput.parse(rou_file, 'person'):
         duration, dist = parse_person(p)
         sumoTime.add(np.array(duration), p.id)
         sumoDist.add(np.array(dist), p.id)
@@ -114,9 +109,9 @@ def _createValueTuple(od, end, real, sumoTime, sumoDist):
 
 
 @benchmark
-def upload_all_pairs(conn, tables, start, end, real_routes, rep_routes, net, startIdx=0):
+def upload_all_pairs(conn, tables, start, end, real_routes, rep_routes, net, startIdx=0, options=None):
     stats = list(_parse_person_info_taz(real_routes, start, end))
-    print("Parsed taz results for %s persons from %s." % (len(stats), real_routes))
+    print("Parsed taz results for %s persons from %s." % (len(stats), getattr(real_routes, "routes", real_routes)))
     stats.extend(_get_all_pair_stats(rep_routes, net))
     stats.sort()
     min_samples = 5
@@ -146,8 +141,13 @@ def upload_all_pairs(conn, tables, start, end, real_routes, rep_routes, net, sta
     for idx, v in enumerate(values):
         odValues.append(v[:4] + (startIdx + idx,))
         entryValues.append(v[4:] + (startIdx + idx, "{car}"))
-    database.insertmany(conn, tables[0], "taz_id_start, taz_id_end, sumo_type, interval_end, entry_id", odValues)
     columns = """realtrip_count, representative_count, travel_time_sec, travel_time_stddev,
                  distance_real, distance_stddev, entry_id, used_modes"""
-    database.insertmany(conn, tables[1], columns, entryValues)
+    try:
+        database.insertmany(conn, tables[0], "taz_id_start, taz_id_end, sumo_type, interval_end, entry_id", odValues, options)
+        database.insertmany(conn, tables[1], columns, entryValues, options)
+    except BaseException:
+        for t in tables:
+            database.abort_table(conn, t)
+        raise
     return startIdx + len(values)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# Copyright (C) 2013-2025 German Aerospace Center (DLR) and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file    simoutput.py
+# @author  agent
+# @date    2026-10-18
+
+# Streaming reader for the SUMO vehroute and tripinfo outputs used by s2t.
+# In contrast to sumolib.output.parse it does not build an object tree per element
+# but keeps only the attributes, params and child elements s2t needs.
+# Routes, exit times and all other children are skipped while parsing, so
+# memory and time do not depend on the length of the routes.
+# Large uncompressed files can be split into shards at top level element
+# boundaries which are parsed by a process pool.
+
+from __future__ import print_function
+import os
+import sys
+import multiprocessing
+from collections import namedtuple
+from xml.parsers import expat
+
+if 'SUMO_HOME' in os.environ:
+    sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
+import sumolib
+
+from tapas_sumo_coupling import constants
+
+CHUNK_SIZE = 1 << 20
+# parallel parsing uses a few shards per process to balance the load
+SHARDS_PER_PROCESS = 4
+MIN_SHARD_SIZE = 4 * CHUNK_SIZE
+KEPT_PARAMS = ("taz_id_start", "taz_id_end", constants.TRIP_GROUP_PARAM)
+# children of vehicles and persons in a vehroute file (the stages of a person)
+ROUTE_CHILDREN = ("walk", "ride")
+# children of a tripinfo in a tripinfo file
+TRIPINFO_CHILDREN = ("emissions",)
+
+Param = namedtuple("Param", ("key", "value"))
+
+
+def _record(name, attrs, param, children):
+    record = Record(name, attrs)
+    record.param = param
+    record.children = children
+    return record
+
+
+class Record(object):
+    """A parsed element behaving like the sumolib objects for the attribute access used in s2t.
+    Missing attributes return None, child elements are available by name and as child list."""
+    __slots__ = ("name", "attrs", "param", "children")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.param = None
+        self.children = []
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or attr in Record.__slots__:
+            raise AttributeError(attr)
+        if attr in self.attrs:
+            return self.attrs[attr]
+        children = [c for c in self.children if c.name == attr]
+        return children or None
+
+    def __reduce__(self):
+        # records are sent from the shard parsing processes
+        return _record, (self.name, self.attrs, self.param, self.children)
+
+    def getChildList(self):
+        return self.children
+
+    def __repr__(self):
+        return "<%s %s>" % (self.name, " ".join('%s="%s"' % a for a in sorted(self.attrs.items())))
+
+
+def _create_parser(element_names, child_names, done):
+    """returns an expat parser appending the finished records to done"""
+    state = {"current": None, "depth": 0}
+
+    def start(name, attrs):
+        current = state["current"]
+        if current is None:
+            if name in element_names:
+                state["current"] = Record(name, attrs)
+                state["depth"] = 1
+            return
+        state["depth"] += 1
+        if state["depth"] == 2:
+            if name in child_names:
+                current.children.append(Record(name, attrs))
+            elif name == "param" and attrs.get("key") in KEPT_PARAMS:
+                if current.param is None:
+                    current.param = []
+                current.param.append(Param(attrs["key"], attrs.get("value")))
+
+    def end(name):
+        if state["current"] is not None:
+            state["depth"] -= 1
+            if state["depth"] == 0:
+                done.append(state["current"])
+                state["current"] = None
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    return parser
+
+
+def _parse_sequential(xmlfile, element_names, child_names):
+    done = []
+    parser = _create_parser(element_names, child_names, done)
+    with sumolib.openz(xmlfile, "rb") as xml_in:
+        while True:
+            chunk = xml_in.read(CHUNK_SIZE)
+            parser.Parse(chunk, not chunk)
+            for record in done:
+                yield record
+            del done[:]
+            if not chunk:
+                break
+
+
+def _is_gzipped(xmlfile):
+    with open(xmlfile, "rb") as xml_in:
+        return xml_in.read(2) == b"\x1f\x8b"
+
+
+def _find_element_start(xml_in, pos, end, tags):
+    """returns the offset of the first start tag out of tags at or after pos (and before end)"""
+    overlap = max([len(t) for t in tags])
+    while pos < end:
+        xml_in.seek(pos)
+        block = xml_in.read(min(CHUNK_SIZE + overlap, end - pos))
+        found = [i for i in [block.find(t) for t in tags] if i >= 0]
+        if found:
+            return pos + min(found)
+        pos += CHUNK_SIZE
+    return None
+
+
+def _root_end(xml_in):
+    """returns the offset directly after the root start tag (skipping the xml declaration and header comments)"""
+    found = []
+
+    def start(name, attrs):
+        found.append(parser.CurrentByteIndex)
+        raise StopIteration
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    try:
+        while not found:
+            chunk = xml_in.read(CHUNK_SIZE)
+            parser.Parse(chunk, not chunk)
+    except StopIteration:
+        pass
+    xml_in.seek(found[0])
+    return found[0] + xml_in.read(CHUNK_SIZE).index(b">") + 1
+
+
+def _shard_offsets(xmlfile, element_names, shards):
+    """splits the file at the start tags of top level elements into the given number of shards of about
+       the same size, returns the offsets of the shard starts and the offset of the closing root tag"""
+    size = os.path.getsize(xmlfile)
+    tags = [("<" + name).encode() + c for name in element_names for c in (b" ", b"\t", b"\n", b"\r", b">", b"/")]
+    offsets = []
+    with open(xmlfile, "rb") as xml_in:
+        xml_in.seek(max(0, size - CHUNK_SIZE))
+        tail = xml_in.read()
+        end = size - len(tail) + tail.rfind(b"</")
+        xml_in.seek(0)
+        begin = _root_end(xml_in)
+        for shard in range(shards):
+            start = _find_element_start(xml_in, max(begin, shard * size // shards), end, tags)
+            if start is None:
+                break
+            if not offsets or start > offsets[-1]:
+                offsets.append(start)
+    return offsets + [end]
+
+
+def _parse_shard(args):
+    xmlfile, begin, end, element_names, child_names = args
+    done = []
+    parser = _create_parser(element_names, child_names, done)
+    with open(xmlfile, "rb") as xml_in:
+        xml_in.seek(begin)
+        parser.Parse(b"<shard>")
+        parser.Parse(xml_in.read(end - begin))
+        parser.Parse(b"</shard>", True)
+    return done
+
+
+def _parse_parallel(xmlfile, element_names, child_names, processes):
+    shards = max(1, min(SHARDS_PER_PROCESS * processes, os.path.getsize(xmlfile) // MIN_SHARD_SIZE))
+    offsets = _shard_offsets(xmlfile, element_names, shards)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for records in pool.imap(_parse_shard, [(xmlfile, b, e, element_names, child_names)
+                                                for b, e in zip(offsets[:-1], offsets[1:])]):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+
+
+def parse(xmlfile, element_names, child_names=ROUTE_CHILDREN, processes=1):
+    """yields a Record for every element with one of the given names (and its direct children with the
+       given child names as well as the taz and trip group params), the file may be gzipped.
+       With more than one process, uncompressed files (of at least two shards) are split at the
+       top level elements and the shards are parsed in parallel, yielding the records in file order.
+       The element names need to be the names of top level elements in this case."""
+    if isinstance(element_names, str):
+        element_names = (element_names,)
+    if processes > 1 and os.path.isfile(xmlfile) and not _is_gzipped(xmlfile) and \
+            os.path.getsize(xmlfile) >= 2 * MIN_SHARD_SIZE:
+        return _parse_parallel(xmlfile, element_names, child_names, processes)
+    return _parse_sequential(xmlfile, element_names, child_names)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright (C) 2013-2025 German Aerospace Center (DLR) and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file    status.py
+# @author  agent
+# @date    2026-10-18
+
+# Writing the status messages of a simulation request to the database
+# from a background thread so the stages never wait for the database.
+
+from __future__ import print_function
+import sys
+import datetime
+import threading
+import time
+import queue
+
+from tapas_sumo_coupling import database
+
+COLUMNS = "sim_key, iteration, status_time, status, msg_type"
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 1.  # seconds before the second attempt, doubled for every further one
+_STOP = object()
+
+
+class StatusClock:
+    """returns strictly increasing time stamps, which serve as sequence numbers for the
+       (sim_key, status_time) primary key of the status table"""
+
+    def __init__(self):
+        self._last = None
+        self._lock = threading.Lock()
+
+    def now(self):
+        with self._lock:
+            now = datetime.datetime.now()
+            if self._last is not None and now <= self._last:
+                now = self._last + datetime.timedelta(microseconds=1)
+            self._last = now
+            return now
+
+
+class StatusWriter:
+    """collects status rows in a queue and inserts them in batches using a single
+       connection which is kept open for all stages of a simulation request"""
+
+    def __init__(self, options, table):
+        self._options = options
+        self._command = "INSERT INTO public.%s (%s) VALUES (?, ?, ?, ?, ?)" % (table, COLUMNS)
+        self._clock = StatusClock()
+        self._unwritten = []
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, sim_key, iteration, message, msg_type):
+        """enqueues a status row and returns immediately"""
+        self._queue.put((sim_key, iteration, self._clock.now(), str(message), msg_type))
+
+    def _insert(self, conn, rows):
+        """inserts the rows retrying with a new connection on failure,
+           returns the connection (None if all attempts failed) and the last error"""
+        delay = RETRY_DELAY
+        for attempt in range(WRITE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                conn = database.get_conn(self._options, conn)
+                database.executemany(conn, self._command, rows)
+                return conn, None
+            except Exception as e:
+                print("Warning! Could not write status:", e, file=sys.stderr)
+                if conn is not None:
+                    conn.close()
+                conn = None
+                error = e
+        return None, error
+
+    def _run(self):
+        conn = None
+        running = True
+        # rows of failed batches are written together with the next batch
+        pending = []
+        while running:
+            pending.append(self._queue.get())
+            while True:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in pending:
+                running = False
+                pending = [r for r in pending if r is not _STOP]
+            if not pending:
+                continue
+            conn, self._error = self._insert(conn, pending)
+            if self._error is None:
+                pending = []
+        self._unwritten = pending
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """writes all pending rows and closes the connection,
+           raises an IOError if some rows could not be written"""
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._unwritten:
+            raise IOError("Could not write %s status messages: %s" % (len(self._unwritten), self._error))
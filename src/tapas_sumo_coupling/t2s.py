@@ -21,17 +21,20 @@
 from __future__ import print_function, division
 import os
 import sys
-import math
-import csv
 import random
-import shutil
 import multiprocessing
-import collections
 import glob
 import re
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 import traceback
 import copy
+import csv
+import hashlib
+import heapq
+import itertools
+import shutil
+import tempfile
 
 if 'SUMO_HOME' in os.environ:
     tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -40,17 +43,14 @@ else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
 import sumolib
-from sumolib.miscutils import benchmark, uMin, uMax, euclidean
+from sumolib.miscutils import benchmark, uMin, uMax
 from sumolib.options import ArgumentParser
 from sumolib.miscutils import parseTime, Statistics
 
 from tapas_sumo_coupling import assign
-from tapas_sumo_coupling.constants import TH, THX, SVC, MODE, CAR_MODES, TAPAS_DAY_OVERLAP_MINUTES, BACKGROUND_TRAFFIC_SUFFIX
-from tapas_sumo_coupling import edgemapper
-from tapas_sumo_coupling.common import csv_sequence_generator, abspath_in_dir, build_uid
-
-class MappingError(Exception):
-    pass
+from tapas_sumo_coupling.constants import TH, THX, SVC, MODE, CAR_MODES, BACKGROUND_TRAFFIC_SUFFIX, CLONE_FLOW_SUFFIX, TRIP_GROUP_PARAM
+from tapas_sumo_coupling import edgemapper, rectify, columnar, manifest
+from tapas_sumo_coupling.common import csv_sequence_generator, chunked_sequence_generator, abspath_in_dir, build_uid, person_random, MappingError
 
 
 def fillOptions(argParser):
@@ -65,6 +65,12 @@ def fillOptions(argParser):
                            help="skip rectifying trips")
     argParser.add_argument("--rectify-only", action="store_true", default=False,
                            help="skip everything, just rectify the trips")
+    argParser.add_argument("--rectify-batch-size", type=int, default=100000,
+                           help="number of persons to rectify at once")
+    argParser.add_argument("--processes", type=int, default=1,
+                           help="number of worker processes for rectifying and mapping trips and for parsing large simulation outputs")
+    argParser.add_argument("--columnar", action="store_true", default=False,
+                           help="store rectified and mapped trips as memory mapped numpy columns instead of CSV")
     argParser.add_argument("-M", "--no-map", action="store_false", dest="domap", default=True,
                            help="skip mapping trips")
     argParser.add_argument("-T", "--no-tripdefs", action="store_false", dest="dotripdefs", default=True,
@@ -75,8 +81,19 @@ def fillOptions(argParser):
                            help="keep trips after a geographic gap in the trip sequence")
     argParser.add_argument("--max-radius", type=float, default=2000.,
                            help="maximum radius when mapping trips")
+    argParser.add_argument("--mapping-cache-dir",
+                           help="keep the edge mapping results in the given directory to reuse them in later runs")
+    argParser.add_argument("--mapping-queue-size", type=int, default=0,
+                           help="maximum number of location chunks in flight when mapping in parallel "
+                                "(default twice the number of processes)")
     argParser.add_argument("--weights", help="weight file for routing")
     argParser.add_argument("-s", "--scale", type=float, default=1.0, help="scale value")
+    argParser.add_argument("--clone-flows", action="store_true", default=False,
+                           help="write the clones of a trip (scale > 1) as a single flow spread over the time diffusion window")
+    argParser.add_argument("--compact-trips", action="store_true", default=False,
+                           help="write car trips with identical edges, vehicle type and depart as a single flow")
+    argParser.add_argument("--tripdefs-buffer-size", type=int, default=1000000,
+                           help="maximum number of trip definitions kept in memory before sorting them into a temporary file")
     argParser.add_argument("--routing-algorithm", default='CHWrapper',
                            help="algorithm to use when calling DUAROUTER")
     argParser.add_argument("-l", "--last-step", type=int, dest="last_step", default=50,
@@ -104,7 +121,12 @@ def fillOptions(argParser):
     argParser.add_argument("-m", "--modes", help="the traffic modes to retrieve as a list of integers")
     argParser.add_argument("--subnet-file", help="specifying the subnet to use to rerun a subnet assignment")
     argParser.add_argument("--resume", action="store_true", default=False,
-                           help="reuse existing files instead of overwriting them")
+                           help="record the inputs of every stage and reuse the results of stages whose inputs did not change")
+    argParser.add_argument("--incremental", action="store_true", default=False,
+                           help="only rectify and map the persons whose trips differ from the previous iteration")
+    argParser.add_argument("--previous-trips-dir",
+                           help="trips directory of the previous iteration for --incremental "
+                                "(default is derived from the iteration directory)")
     argParser.add_argument("-b", "--representatives-bbox",
                            help="bounding box to limit valid taz represantives (west,south,east,north)")
     argParser.add_argument("--trip-emissions", metavar="FILE",
@@ -151,10 +173,11 @@ def checkOptions(options):
             assert options.iteration_dir is not None, "iteration or trips directory need to be given"
             assert os.path.isdir(options.iteration_dir), "the given iteration directory %s is not accessible" % options.iteration_dir
             options.trips_dir = os.path.join(options.iteration_dir, 'trips')
-        options.rectified = abspath_in_dir(options.trips_dir, 'rectified_%s.csv' % base)
+        ext = columnar.SUFFIX if options.columnar else ".csv"
+        options.rectified = abspath_in_dir(options.trips_dir, 'rectified_%s%s' % (base, ext))
         options.rectified_log = abspath_in_dir(options.trips_dir, 't2s_rectify_%s.log' % base)
 
-        options.mapped_trips = abspath_in_dir(options.trips_dir, 'mapped_%s.csv' % base)
+        options.mapped_trips = abspath_in_dir(options.trips_dir, 'mapped_%s%s' % (base, ext))
         options.mapped_log = abspath_in_dir(options.trips_dir, 't2s_map_%s.log' % base)
         options.trips_for_dua = getSumoTripfileName(options.trips_dir, options.tapas_trips)
     else:
@@ -181,7 +204,7 @@ def get_logger(file):
 
 ###############################################################################
 @benchmark
-def rectify_input(options):
+def rectify_input(options, person_keys=None):
     # convert depart-time to seconds
     #   add random seconds from [-options.diffuse/2, options.diffuse/2] to reduce traffic bursts
     #   (right now the most important trip for each person is aligned to 5min slot
@@ -197,171 +220,142 @@ def rectify_input(options):
     # diffuse geoCoordinates with a gaussian (mu = 0, sigma = spatialDiffuse meters)
     # since tapas inputs tends to show strong spatial clustering (call it
     # parking related diffusion)
-    diffusion_map = {}
-    modes = options.modes.split(",")
-    if options.max_spatial_diffusion > 0:
-        loc_count = collections.defaultdict(int)
-        for row in csv.DictReader(open(options.tapas_trips)):
-            if row[TH.mode] in modes:
-                loc_count[(row[TH.source_long], row[TH.source_lat])] += 1
-                loc_count[(row[TH.dest_long], row[TH.dest_lat])] += 1
-        for coord, count in loc_count.items():
-            if count >= options.spatial_diffusion_bounds[0]:
-                scale = float(count - options.spatial_diffusion_bounds[0]) / (options.spatial_diffusion_bounds[1] - options.spatial_diffusion_bounds[0])
-                diffusion = scale * (options.max_spatial_diffusion - options.spatial_diffusion) + options.spatial_diffusion
-                if diffusion < options.max_spatial_diffusion:
-                    diffusion_map[coord] = diffusion
-    if os.path.exists(options.location_priority_file):
-        for loc in sumolib.xml.parse(options.location_priority_file, "poi"):
-            diffusion_map[(loc.lon, loc.lat)] = 0
     with open(options.rectified_log, 'w') as logfile:
-        log = get_logger(logfile)
-        writer = csv.DictWriter(
-            open(options.rectified, 'w'),
-            THX.fieldnames,
-            extrasaction='ignore', lineterminator='\n')
-        writer.writeheader()
-
-        persons = 0
-        rows = 0
-        gaps = 0
-        gap_sum = 0
-        max_gap = 0
-        max_gap_uid = None
-        max_depart = 0
-        max_depart_uid = None
-        inconsistent = 0
-        skipped_wrong_mode = 0
-        skipped_wrong_depart = 0
-
-        # asserts that each person appears only in one consecutive sequence of
-        # # entries
-        gen = csv_sequence_generator(
-            options.tapas_trips, (TH.person_id, TH.household_id), assertUniqe=True)
-        for (pid, _), trip_sequence in gen:
-            persons += 1
-            previous_dest = None
-            previous_end = None
-            previous_depart = None
-            spatial_offset = None
-            # smooth bursts due to low resolution
-            smoothing_offset = int(random.random() * (options.time_diffusion+1)) - options.time_diffusion // 2
-            for row in trip_sequence:
-                rows += 1
-                uid = build_uid(row)
-                source_coord = (row[TH.source_long], row[TH.source_lat])
-                source = options.net.convertLonLat2XY(*source_coord)
-                if spatial_offset is None:
-                    if source_coord in diffusion_map:
-                        spatial_offset = [random.gauss(0, diffusion_map[source_coord]) for i in range(2)]
-                    elif options.max_spatial_diffusion <= 0 and options.spatial_diffusion > 0:
-                        spatial_offset = [random.gauss(0, options.spatial_diffusion) for i in range(2)]
-                dest_coord = (row[TH.dest_long], row[TH.dest_lat])
-                dest = options.net.convertLonLat2XY(*dest_coord)
-                depart_minute = int(row[TH.depart_minute])
-                depart = depart_minute * 60 + smoothing_offset
-                duration = float(row[TH.duration])
-                activity_duration = int(row[TH.activity_duration_minutes]) * 60
-
-                if depart_minute - 24 * 60 >= TAPAS_DAY_OVERLAP_MINUTES or depart_minute <= -TAPAS_DAY_OVERLAP_MINUTES:
-                    log("Warning: dropping trip %s because it starts on the wrong day (minute %s)" % (
-                        uid, depart_minute))
-                    skipped_wrong_depart += 1
-                    if depart_minute > max_depart:
-                        max_depart = depart_minute
-                        max_depart_uid = uid
-                    continue
-
-                row[THX.depart_second] = depart
-                if math.isnan(duration):
-                    log('Warning: NaN value in duration of trip %s' % uid)
-                    duration = 1
-                    row[TH.duration] = duration
-
-                if previous_end is not None and depart < previous_end:
-                    if (previous_end - depart >= 60):
-                        # input data only has minute resolution anyway and may
-                        # suffer from rounding
-                        inconsistent += 1
-                        log("Warning: inconsistent depart time for trip %s (%s seconds)" %
-                            (uid, previous_end - depart))
-                    depart = previous_end
-
-                previous_end = int(depart + duration + activity_duration)
-
-                if previous_depart is not None and depart < previous_depart:
-                    raise MappingError(
-                        'Unordered trips for person %s at departure %s' % (pid, depart_minute))
-                previous_depart = depart
-
-                # close gaps in trip sequence
-                if previous_dest and previous_dest != source and not options.ignore_gaps:
-                    gaps += 1
-                    gap = euclidean(previous_dest, source)
-                    gap_sum += gap
-                    max_gap = max(max_gap, gap)
-                    max_gap_uid = uid
-                    # to many to list them all
-                    # print('Warning: gap in edge sequence at trip %s (length %s)' % (uid, gap))
-                    # XXX add teleport-trip for closing the gap
-                    # row[TH.source_long] = previous_row[TH.dest_long]
-                    # row[TH.source_lat] = previous_row[TH.dest_lat]
-                    continue
-                previous_dest = dest
-
-                if spatial_offset is not None:
-                    row[TH.source_long], row[TH.source_lat] = options.net.convertXY2LonLat(
-                        source[0] + spatial_offset[0], source[1] + spatial_offset[1])
-                    if dest_coord in diffusion_map:
-                        spatial_offset = [random.gauss(0, diffusion_map[dest_coord]) for i in range(2)]
-                    else:
-                        spatial_offset = [random.gauss(0, options.spatial_diffusion) for i in range(2)]
-                    row[TH.dest_long], row[TH.dest_lat] = options.net.convertXY2LonLat(
-                        dest[0] + spatial_offset[0], dest[1] + spatial_offset[1])
-
-                if row[TH.mode] in modes:
-                    writer.writerow(row)
-                else:
-                    skipped_wrong_mode += 1
-
-        log('Read %s persons with a total of %s trips from input file "%s".' %
-            (persons, rows, options.tapas_trips))
-        if skipped_wrong_mode > 0:
-            log('Dropped %s trips because they have the wrong mode' %
-                skipped_wrong_mode)
-        log('%s trips have inconsistent depart times.' % inconsistent)
-        if gaps > 0:
-            log('Dropped %s trips because of gaps, avg: %s, maximum: %s (for trip %s).' %
-                (gaps, gap_sum / gaps, max_gap, max_gap_uid))
-        if skipped_wrong_depart > 0:
-            log('Dropped %d trips because they start on the wrong day (maximum: %s for trip %s).' %
-                (skipped_wrong_depart, max_depart, max_depart_uid))
+        rectify.rectify_trips(options, get_logger(logfile), person_keys)
 
 
 ###############################################################################
 # map geocoordinates to network edges
-def map_trips(trip_sequence, vTypes, max_radius):
+MAP_CHUNK_SIZE = 10000
+# the options which influence the results of the stages (besides the input files)
+RECTIFY_OPTIONS = ("modes", "seed", "time_diffusion", "spatial_diffusion", "max_spatial_diffusion",
+                   "spatial_diffusion_bounds", "ignore_gaps")
+MAP_OPTIONS = ("max_radius",)
+# the manifest next to the mapped trips which --incremental compares with the previous iteration
+REUSE_SUFFIX = ".reuse" + manifest.SUFFIX
+TRIPDEFS_OPTIONS = ("scale", "seed", "time_diffusion", "shiftdeparthours", "default_vtype", "bike_type",
+                    "clone_flows", "compact_trips")
+
+
+def get_vclass(mode, vtype, vTypes):
+    if mode in CAR_MODES:
+        return vTypes.get(vtype, SVC.passenger)
+    return SVC.pedestrian
+
+
+def get_mapping_keys(source, taz_id_start, dest, taz_id_end, vClass):
+    """returns for source and destination either the key for the edge mapper
+       or the edge (taz) to use directly"""
+    result = []
+    for xy, taz in ((source, taz_id_start), (dest, taz_id_end)):
+        if taz.startswith("-") and xy not in edgemapper.get_location_prios():
+            result.append((None, taz[1:]))
+        else:
+            result.append(((xy, taz, vClass), None))
+    return result
+
+
+def collect_locations(rectified, vTypes):
+    """returns the projected coordinates of all locations in the trip file
+       and the distinct keys which need to be mapped"""
+    fields = (TH.source_long, TH.source_lat, TH.dest_long, TH.dest_lat,
+              TH.taz_id_start, TH.taz_id_end, TH.mode, TH.vtype)
+    # collect the distinct combinations first, so memory grows with the number of locations, not trips
+    combinations = {}
+    coordinates = set()
+    for (source_long, source_lat, dest_long, dest_lat,
+         taz_id_start, taz_id_end, mode, vtype) in columnar.tuple_generator(rectified, fields):
+        source = (source_long, source_lat)
+        dest = (dest_long, dest_lat)
+        combinations[(source, dest, taz_id_start, taz_id_end, get_vclass(mode, vtype, vTypes))] = None
+        coordinates.add(source)
+        coordinates.add(dest)
+    locations = edgemapper.convert_locations(coordinates)
+    keys = {}
+    for s, d, taz_id_start, taz_id_end, vClass in combinations:
+        for key, _ in get_mapping_keys(locations[s], taz_id_start, locations[d], taz_id_end, vClass):
+            if key is not None:
+                keys[key] = None
+    return locations, list(keys)
+
+
+def map_locations(args):
+    keys, max_radius = args
+    return edgemapper.map_to_edges(keys, max_radius=max_radius)
+
+
+def mapped_chunks(options, keys, parallel):
+    """yields the chunks of keys together with their mapping results in order,
+       keeping at most options.mapping_queue_size chunks in flight"""
+    if not parallel:
+        for i in range(0, len(keys), MAP_CHUNK_SIZE):
+            chunk = keys[i:i + MAP_CHUNK_SIZE]
+            yield chunk, edgemapper.map_to_edges(chunk, max_radius=options.max_radius)
+        return
+    # the results from the mapping cache are taken here, only the other keys go to the workers
+    cached, keys = edgemapper.split_cached(keys)
+    if cached:
+        yield cached, edgemapper.map_to_edges(cached, max_radius=options.max_radius)
+    if not keys:
+        return
+    chunks = (keys[i:i + MAP_CHUNK_SIZE] for i in range(0, len(keys), MAP_CHUNK_SIZE))
+    window = options.mapping_queue_size or 2 * options.processes
+    # the workers memory map the edge geometry instead of loading the network themselves
+    geometry_dir = tempfile.mkdtemp(prefix="geometry", dir=os.path.dirname(options.mapped_trips))
+    edgemapper.export_geometry(geometry_dir, set([key[2] for key in keys]))
+    pool = multiprocessing.Pool(options.processes, edgemapper.attach,
+                                (geometry_dir, edgemapper.get_location_prios(), getattr(options, "mapping_cache", None)))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= window:
+                done, result = pending.popleft()
+                yield done, result.get()
+            pending.append((chunk, pool.apply_async(map_locations, ((chunk, options.max_radius),))))
+        while pending:
+            done, result = pending.popleft()
+            yield done, result.get()
+        pool.close()
+        pool.join()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        shutil.rmtree(geometry_dir, ignore_errors=True)
+
+
+class MappingResults(dict):
+    """the mapping results for the distinct keys, fetching further chunks
+       from the ordered result stream when a key is not yet known"""
+
+    def __init__(self, chunks):
+        dict.__init__(self)
+        self._chunks = chunks
+
+    def __missing__(self, key):
+        for chunk, result in self._chunks:
+            self.update(zip(chunk, result))
+            if key in self:
+                return self[key]
+        raise KeyError(key)
+
+    def finish(self):
+        for chunk, result in self._chunks:
+            self.update(zip(chunk, result))
+
+
+def map_trips(trip_sequence, vTypes, locations, mapping):
     rows = []
     try:
         for row in trip_sequence:
-            if row[TH.mode] in CAR_MODES:
-                vClass = vTypes.get(row[TH.vtype], SVC.passenger)
-            else:
-                vClass = SVC.pedestrian
-            taz_id_start = row[TH.taz_id_start]
-            taz_id_end = row[TH.taz_id_end]
-            source = edgemapper.convertLonLat2XY(row[TH.source_long], row[TH.source_lat])
-            dest = edgemapper.convertLonLat2XY(row[TH.dest_long], row[TH.dest_lat])
+            vClass = get_vclass(row[TH.mode], row[TH.vtype], vTypes)
+            source = locations[(row[TH.source_long], row[TH.source_lat])]
+            dest = locations[(row[TH.dest_long], row[TH.dest_lat])]
             if edgemapper.trip_filter(row, source, dest):
                 continue
-            if taz_id_start.startswith("-") and source not in edgemapper.get_location_prios():
-                source_map = (None, taz_id_start[1:], None, None)
-            else:
-                source_map = edgemapper.map_to_edge(source, taz_id_start, vClass, max_radius=max_radius)
-            if taz_id_end.startswith("-") and dest not in edgemapper.get_location_prios():
-                dest_map = (None, taz_id_end[1:], None, None)
-            else:
-                dest_map = edgemapper.map_to_edge(dest, taz_id_end, vClass, max_radius=max_radius)
+            source_map, dest_map = [mapping[key] if key is not None else (None, edge, None, None)
+                                    for key, edge in get_mapping_keys(source, row[TH.taz_id_start],
+                                                                      dest, row[TH.taz_id_end], vClass)]
             row[THX.source_edge] = source_map[1]
             row[THX.dest_edge] = dest_map[1]
             row[THX.departpos] = 0
@@ -410,7 +404,7 @@ def writeResults(res, writer, tazMap, deviations, log):
 
 
 @benchmark
-def map_to_edges(options, parallel=False):
+def map_to_edges(options, parallel=False, allow_empty=False):
     vTypes = {}
     if os.path.exists(options.vtype_file):
         for t in sumolib.output.parse(options.vtype_file, "vType"):
@@ -421,12 +415,6 @@ def map_to_edges(options, parallel=False):
         for t in sumolib.output.parse_fast(options.taz_file, "taz", ["id", "edges"]):
             tazMap[t.id] = set(t.edges.split())
 
-    writer = csv.DictWriter(
-        open(options.mapped_trips, 'w'),
-        THX.fieldnames,
-        extrasaction='ignore')
-    writer.writeheader()
-
     persons = 0
     rows = 0
     deviations = Statistics("Mapping deviations")
@@ -434,57 +422,248 @@ def map_to_edges(options, parallel=False):
     deviations.noTazEdge = 0
     deviations.reported = set()
 
-    with open(options.mapped_log, 'w') as logfile:
-        if os.name == "nt":
-            options = copy.copy(options)
-            options.net = None
-            options.script_module = None
-        if parallel:
-            pool = multiprocessing.Pool(multiprocessing.cpu_count(), edgemapper.init, (options, tazMap))
-            results = []
-        else:
-            edgemapper.init(options, tazMap)
+    if options.mapping_cache_dir:
+        options.mapping_cache = edgemapper.get_cache_dir(options)
+    with columnar.open_writer(options.mapped_trips, THX.fieldnames) as writer, open(options.mapped_log, 'w') as logfile:
+        edgemapper.init(options, tazMap)
         log = get_logger(logfile)
         log('Mapping using %s.' % options.taz_file)
+        start = time.time()
+        # map every distinct location only once and join the results with the trips afterwards
+        locations, keys = collect_locations(options.rectified, vTypes)
+        # the trips of a person are written as soon as the chunks containing their locations are mapped
+        mapping = MappingResults(mapped_chunks(options, keys, parallel))
         for _, trip_sequence in csv_sequence_generator(options.rectified, (TH.person_id, TH.household_id)):
             persons += 1
-            if parallel:
-                results.append(pool.apply_async(map_trips, args=(trip_sequence, vTypes, options.max_radius)))
-                if persons % 1000000 == 0:
-                    for proc in results:
-                        rows += writeResults(proc.get(), writer, tazMap, deviations, log)
-                    results.clear()
-            else:
-                res = map_trips(trip_sequence, vTypes, options.max_radius)
-                rows += writeResults(res, writer, tazMap, deviations, log)
-        if parallel:
-            pool.close()
-            pool.join()
-            for proc in results:
-                rows += writeResults(proc.get(), writer, tazMap, deviations, log)
+            res = map_trips(trip_sequence, vTypes, locations, mapping)
+            rows += writeResults(res, writer, tazMap, deviations, log)
+        mapping.finish()
+        edgemapper.close_cache()
+        duration = max(time.time() - start, 1e-6)
+        log('mapped %s persons in %.2f seconds (%.1f persons/s)' % (persons, duration, persons / duration))
+        if options.mapping_cache_dir:
+            log('%s mapping results in cache %s' % (edgemapper.compact_cache(options.mapping_cache), options.mapping_cache))
         log('read %d TAPAS trips for %s persons (%s unmappable)' % (rows, persons, deviations.unmapped))
-        if rows == deviations.unmapped and deviations.unmapped > 0:
+        if rows == deviations.unmapped and deviations.unmapped > 0 and not allow_empty:
             raise MappingError('No trips left after mapping.')
         log(deviations)  # error when mapping to junction coords
         log("%s mappings did not find an edge in the correct taz" % deviations.noTazEdge)
 
 
+###############################################################################
+# reuse the results of the previous iteration for unchanged persons
+def get_person_digests(csvfile):
+    """returns the header and a digest of the trips for every (person_id, household_id) in input order"""
+    digests = {}
+    with open(csvfile) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        pid = header.index(TH.person_id)
+        hh = header.index(TH.household_id)
+        for row in reader:
+            key = (row[pid], row[hh])
+            if key not in digests:
+                digests[key] = hashlib.sha1()
+            digests[key].update(repr(row).encode())
+    return header, dict([(key, digest.digest()) for key, digest in digests.items()])
+
+
+class PersonReader:
+    """reads the rows of a rectified or mapped trip file person by person without loading the whole file,
+       the persons (with at least one trip) appear in the file in the order of the given positions,
+       persons which are requested later than they appear in the file are buffered"""
+
+    def __init__(self, path, positions, wanted):
+        self.fieldnames = columnar.get_fieldnames(path)
+        pid = self.fieldnames.index(TH.person_id)
+        hh = self.fieldnames.index(TH.household_id)
+        self._groups = chunked_sequence_generator(columnar.tuple_generator(path, self.fieldnames),
+                                                  lambda row: (row[pid], row[hh]))
+        self._positions = positions
+        self._wanted = wanted
+        self._next = None
+        self._buffer = {}
+
+    def get(self, key):
+        """returns the rows of the given person (an empty list if the person has no trips in the file)"""
+        if key in self._buffer:
+            return self._buffer.pop(key)
+        position = self._positions.get(key)
+        if position is None:
+            return []
+        while True:
+            if self._next is None:
+                self._next = next(self._groups, None)
+                if self._next is None:
+                    return []
+            group_key, rows = self._next
+            if group_key == key:
+                self._next = None
+                return rows
+            if self._positions.get(group_key, -1) > position:
+                # the requested person would have appeared before
+                return []
+            self._next = None
+            if group_key in self._wanted:
+                self._buffer[group_key] = rows
+
+
+def merge_persons(order, previous_order, changed, changed_file, previous_file, dest, lineterminator):
+    """writes the rows of all persons in the given order, taking the changed
+       persons from changed_file and all others from previous_file,
+       both files are read sequentially (in order and previous_order respectively)"""
+    positions = dict([(key, idx) for idx, key in enumerate(order)])
+    previous_positions = dict([(key, idx) for idx, key in enumerate(previous_order)])
+    current = PersonReader(changed_file, positions, changed)
+    previous = PersonReader(previous_file, previous_positions, set([key for key in order if key not in changed]))
+    rows = 0
+    with columnar.open_writer(dest, previous.fieldnames, lineterminator) as writer:
+        for key in order:
+            person_rows = (current if key in changed else previous).get(key)
+            writer.writetuples(person_rows)
+            rows += len(person_rows)
+    return rows
+
+
+def get_previous_trips_dir(options):
+    if options.previous_trips_dir is not None:
+        return options.previous_trips_dir
+    if options.iteration_dir is not None:
+        iteration_dir = os.path.normpath(options.iteration_dir)
+        m = re.match(r"iteration(\d+)$", os.path.basename(iteration_dir))
+        if m and int(m.group(1)) > 0:
+            return os.path.join(os.path.dirname(iteration_dir), "iteration%03i" % (int(m.group(1)) - 1), "trips")
+    return None
+
+
+def get_reuse_stage(options):
+    """returns the stage recording the inputs and options (besides the trips) the mapped trips of an iteration depend on"""
+    return manifest.Stage("reuse", [options.mapped_trips],
+                          [options.net_file, options.taz_file, options.vtype_file, options.location_priority_file],
+                          get_stage_params(options, RECTIFY_OPTIONS + MAP_OPTIONS),
+                          options.mapped_trips + REUSE_SUFFIX)
+
+
+@benchmark
+def remap_changed_persons(options):
+    """rectifies and maps only the persons whose trips differ from the previous iteration
+       and takes the results for all other persons from there,
+       returns False if the files of the previous iteration are not usable"""
+    previous_dir = get_previous_trips_dir(options)
+    if previous_dir is None:
+        return False
+    previous = [os.path.join(previous_dir, os.path.basename(f))
+                for f in (options.tapas_trips, options.rectified, options.mapped_trips)]
+    if not all([os.path.exists(f) for f in previous]) or os.path.abspath(previous[0]) == options.tapas_trips:
+        print("no usable results of a previous iteration in %s, processing all persons" % previous_dir)
+        return False
+    if manifest.read_digest(previous[2] + REUSE_SUFFIX) != get_reuse_stage(options).digest():
+        print("the options or the network changed since the previous iteration, processing all persons")
+        return False
+    header, digests = get_person_digests(options.tapas_trips)
+    previous_header, previous_digests = get_person_digests(previous[0])
+    if header != previous_header:
+        print("the trip file format changed since the previous iteration, processing all persons")
+        return False
+    changed = set([key for key, digest in digests.items() if previous_digests.get(key) != digest])
+    print("reusing the trips of %s out of %s persons from %s" %
+          (len(digests) - len(changed), len(digests), previous_dir))
+    changed_options = copy.copy(options)
+    base = os.path.basename(options.tapas_trips)[:-4]
+    ext = columnar.SUFFIX if options.columnar else ".csv"
+    changed_options.rectified = abspath_in_dir(options.trips_dir, 'rectified_%s_changed%s' % (base, ext))
+    changed_options.mapped_trips = abspath_in_dir(options.trips_dir, 'mapped_%s_changed%s' % (base, ext))
+    rectify_input(changed_options, changed)
+    # all trips of the changed persons may be unmappable while the unchanged persons still have trips
+    map_to_edges(changed_options, options.processes > 1, allow_empty=True)
+    merge_persons(digests, previous_digests, changed, changed_options.rectified, previous[1], options.rectified, '\n')
+    rows = merge_persons(digests, previous_digests, changed, changed_options.mapped_trips, previous[2], options.mapped_trips, '\r\n')
+    columnar.remove_trips(changed_options.rectified)
+    columnar.remove_trips(changed_options.mapped_trips)
+    if rows == 0:
+        raise MappingError('No trips left after mapping.')
+    return True
+
+
 ###############################################################################
 # create trips as input for duarouter or sumo (route car and taxi trips)
+# marks the car trips in the sorted runs which may be combined to flows (see --compact-trips)
+GROUP_RECORD = "\tgroup\t"
+
+
+def write_sorted_run(trip_lines, directory):
+    """sorts the (depart, line) pairs and writes them to a temporary file, returning its name"""
+    trip_lines.sort()
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='tripdefs', suffix='.tmp', delete=False) as run:
+        for depart, line in trip_lines:
+            run.write('%s %s' % (depart, line))
+    return run.name
+
+
+def read_sorted_run(name):
+    with open(name) as run:
+        for line in run:
+            depart, entry = line.split(' ', 1)
+            yield int(depart), entry
+
+
+def group_record(index, fro, to, vtype, param, uid):
+    """returns a placeholder entry for a car trip which may be combined with identical trips of the same departure"""
+    return GROUP_RECORD + "\t".join((str(index), fro, to, vtype, param, uid)) + "\n"
+
+
+def compact_groups(depart, entries):
+    """replaces the group records of a departure by a trip or a flow per group of identical trips,
+       returns the sorted entries and the number of additional vehicles in the flows"""
+    result = []
+    records = []
+    for entry in entries:
+        if entry.startswith(GROUP_RECORD):
+            index, fro, to, vtype, param, uid = entry[len(GROUP_RECORD):-1].split("\t")
+            records.append((int(index), (fro, to, vtype, param), uid))
+        else:
+            result.append(entry)
+    groups = {}
+    for _, key, uid in sorted(records):
+        groups.setdefault(key, []).append(uid)
+    flow_vehicles = 0
+    for (fro, to, vtype, param), uids in groups.items():
+        if len(uids) == 1:
+            entry = '    <trip id="%s" depart="%s"%s%s type="%s">%s</trip>\n' % (
+                uids[0], depart, fro, to, vtype, param)
+        else:
+            # SUMO numbers the vehicles <flow id>.<index>, which resolve_uid maps to the members
+            entry = '    <flow id="%s_group" begin="%s" end="%s" number="%s"%s%s type="%s">%s<param key="%s" value="%s"/></flow>\n' % (
+                uids[0], depart, depart + 1, len(uids), fro, to, vtype, param, TRIP_GROUP_PARAM, " ".join(uids))
+            flow_vehicles += len(uids) - 1
+        result.append(entry)
+    result.sort()
+    return result, flow_vehicles
+
+
 @benchmark
 def create_sumo_tripdefs(options, scale, suffix, vtype_map):
     trip_lines = []
+    runs = []
+    num_lines = 0
+    flow_vehicles = 0  # vehicles of flows besides the first one
     trips_read = 0
-    for row in csv.DictReader(open(options.mapped_trips)):
+    person = None
+    fields = (TH.person_id, TH.household_id, TH.depart_minute, TH.mode, TH.taz_id_start, TH.taz_id_end,
+              TH.vtype, THX.source_edge, THX.dest_edge, THX.depart_second)
+    for row in columnar.row_generator(options.mapped_trips, fields):
         mode = row[TH.mode]
         trips_read += 1
+        if person != (row[TH.person_id], row[TH.household_id]):
+            person = (row[TH.person_id], row[TH.household_id])
+            rng = person_random(options.seed, person[0], person[1], "tripdefs")
         num_clones = 0
         if scale > 1.:
             num_clones = int(scale - 1)
             # do randomized rounding
-            if random.random() < scale - int(scale):
+            if rng.random() < scale - int(scale):
                 num_clones += 1
-        elif random.random() > scale:
+        elif rng.random() > scale:
             continue
         param = ""
         if row[TH.taz_id_start]:
@@ -517,16 +696,35 @@ def create_sumo_tripdefs(options, scale, suffix, vtype_map):
         if mode in (MODE.sharing,):
             usable_modes.append("taxi")
         mode_string = (' modes="%s"' % " ".join(usable_modes)) if usable_modes else ""
-        if mode in CAR_MODES:
-            entry = '    <trip id="%s" depart="%s"%s%s type="%s">%s</trip>\n' % (
-                build_uid(row, suffix), depart, fro, to, vtype, param)
+        if mode in CAR_MODES and options.compact_trips:
+            # identical trips are combined to a single flow when merging the sorted departures below
+            trip_lines.append((depart, group_record(trips_read, fro, to, vtype, param, build_uid(row, suffix))))
         else:
-            entry = '    <person id="%s" depart="%s"%s><personTrip%s%s%s/>%s</person>\n' % (
-                build_uid(row, suffix), depart, person_type, fro, to, mode_string, param)
-        trip_lines.append((int(depart), entry))
+            if mode in CAR_MODES:
+                entry = '    <trip id="%s" depart="%s"%s%s type="%s">%s</trip>\n' % (
+                    build_uid(row, suffix), depart, fro, to, vtype, param)
+            else:
+                entry = '    <person id="%s" depart="%s"%s><personTrip%s%s%s/>%s</person>\n' % (
+                    build_uid(row, suffix), depart, person_type, fro, to, mode_string, param)
+            trip_lines.append((int(depart), entry))
+        if options.clone_flows and num_clones > 0:
+            # the clones depart evenly spaced over the time diffusion window with a random shift,
+            # SUMO names them <flow id>.<index> which parse_uid translates back to the clone index
+            period = (options.time_diffusion + 1) / num_clones
+            begin = int(row[TH.depart_minute]) * 60 - options.time_diffusion // 2 + 24 * 3600 + int(rng.random() * period)
+            end = begin + options.time_diffusion + 1
+            if mode in CAR_MODES:
+                entry = '    <flow id="%s" begin="%s" end="%s" number="%s"%s%s type="%s">%s</flow>\n' % (
+                    build_uid(row, CLONE_FLOW_SUFFIX), begin, end, num_clones, fro, to, vtype, param)
+            else:
+                entry = '    <personFlow id="%s" begin="%s" end="%s" number="%s"><personTrip %s%s%s/>%s</personFlow>\n' % (
+                    build_uid(row, CLONE_FLOW_SUFFIX), begin, end, num_clones, fro, to, mode_string, param)
+            trip_lines.append((begin, entry))
+            flow_vehicles += num_clones - 1
+            num_clones = 0
         for idx in range(num_clones):
             # smooth bursts due to low resolution
-            smoothing_offset = int(random.random() * (options.time_diffusion+1)) - options.time_diffusion // 2
+            smoothing_offset = int(rng.random() * (options.time_diffusion+1)) - options.time_diffusion // 2
             depart = int(row[TH.depart_minute]) * 60 + smoothing_offset + 24 * 3600
             if mode in CAR_MODES:
                 entry = '    <trip id="%s" depart="%s"%s%s type="%s">%s</trip>\n' % (
@@ -535,31 +733,45 @@ def create_sumo_tripdefs(options, scale, suffix, vtype_map):
                 entry = '    <person id="%s" depart="%s"><personTrip %s%s%s/>%s</person>\n' % (
                     build_uid(row, idx + 1), depart, fro, to, mode_string, param)
             trip_lines.append((int(depart), entry))
+        if len(trip_lines) >= options.tripdefs_buffer_size:
+            runs.append(write_sorted_run(trip_lines, os.path.dirname(options.trips_for_dua)))
+            trip_lines = []
 
     # we sort the tripdefs by departure. this way the output can be used as a reference
-    # simulation input
+    # simulation input, larger inputs are merged from sorted temporary files
     trip_lines.sort()
-    if len(trip_lines)>0:
-        first_depart = trip_lines[0][0]
-        last_depart = trip_lines[-1][0]
-    else:
-        first_depart = 0
-        last_depart = 0
-
-    with open(options.trips_for_dua, 'w') as tripfile_passenger:
-        tripfile_passenger.write(
-            '<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">\n')
-
-        for depart, line in trip_lines:
-            tripfile_passenger.write(line)
-        tripfile_passenger.write("</routes>\n")
+    first_depart = 0
+    last_depart = 0
+    try:
+        with open(options.trips_for_dua, 'w') as tripfile_passenger:
+            tripfile_passenger.write(
+                '<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">\n')
+
+            merged = heapq.merge(*([read_sorted_run(r) for r in runs] + [trip_lines])) if runs else trip_lines
+            # only the entries of a single departure second are held in memory for compacting
+            for depart, lines in itertools.groupby(merged, key=lambda x: x[0]):
+                if num_lines == 0:
+                    first_depart = depart
+                last_depart = depart
+                entries, vehicles = compact_groups(depart, [line for _, line in lines])
+                flow_vehicles += vehicles
+                num_lines += len(entries)
+                tripfile_passenger.writelines(entries)
+            tripfile_passenger.write("</routes>\n")
+    finally:
+        for run in runs:
+            os.remove(run)
 
     print('read trip definitions for %s vehicles' % trips_read)
     print('created trip definitions for %s vehicles starting between %s and %s' %
-          (len(trip_lines), first_depart, last_depart))
+          (num_lines + flow_vehicles, first_depart, last_depart))
     return first_depart, last_depart
 
 
+def get_stage_params(options, names):
+    return dict([(name, getattr(options, name, None)) for name in names])
+
+
 @benchmark
 def main(options):
     checkOptions(options)
@@ -583,43 +795,69 @@ def main(options):
                           glob.glob(os.path.join(options.iteration_dir, "oneshot", "aggregated*.xml"))[0], options.subnet_file)
         return
 
-    if options.rectify and (not options.resume or not os.path.isfile(options.rectified)):
-        rectify_input(options)
-        if options.rectify_only:
-            return
-    else:
-        if os.path.isfile(options.rectified):
-            print("using previous version of %s" % options.rectified)
-        else:
-            print("using %s as rectified input" % options.tapas_trips)
-            shutil.copyfile(options.tapas_trips, options.rectified)
-
-    if options.domap and (not options.resume or not os.path.isfile(options.mapped_trips)):
-        map_to_edges(options)
+    rectify_stage = manifest.Stage("rectify", [options.rectified],
+                                   [options.tapas_trips, options.net_file, options.location_priority_file],
+                                   get_stage_params(options, RECTIFY_OPTIONS))
+    map_stage = manifest.Stage("map", [options.mapped_trips],
+                               [options.rectified, options.net_file, options.taz_file, options.vtype_file,
+                                options.location_priority_file], get_stage_params(options, MAP_OPTIONS))
+    rectified_current = options.rectify and rectify_stage.skip(options.resume)
+    # the map stage depends on the rectified trips, so it is checked once they are final
+    mapped_current = rectified_current and options.domap and map_stage.skip(options.resume)
+    if (options.incremental and options.rectify and options.domap and not options.rectify_only
+            and not mapped_current and remap_changed_persons(options)):
+        rectify_stage.record(options.resume)
+        map_stage.record(options.resume)
+        get_reuse_stage(options).record(options.incremental)
         if options.map_and_exit:
             return
     else:
-        if os.path.isfile(options.mapped_trips):
-            print("using previous version of %s" % options.mapped_trips)
+        if options.rectify and not rectified_current:
+            rectify_input(options)
+            rectify_stage.record(options.resume)
+            if options.rectify_only:
+                return
         else:
-            if options.iteration_dir is not None:
-                print("Cannot continue with assignment because %s is missing" %
-                      options.mapped_trips)
+            if os.path.exists(options.rectified):
+                print("using previous version of %s" % options.rectified)
+            else:
+                print("using %s as rectified input" % options.tapas_trips)
+                columnar.copy_trips(options.tapas_trips, options.rectified)
+
+        if options.domap and not rectified_current:
+            mapped_current = map_stage.skip(options.resume)
+        if options.domap and not mapped_current:
+            map_to_edges(options, options.processes > 1)
+            map_stage.record(options.resume)
+            get_reuse_stage(options).record(options.incremental)
+            if options.map_and_exit:
                 return
+        else:
+            if os.path.exists(options.mapped_trips):
+                print("using previous version of %s" % options.mapped_trips)
+            else:
+                if options.iteration_dir is not None:
+                    print("Cannot continue with assignment because %s is missing" %
+                          options.mapped_trips)
+                    return
 
     # IV-Routing
     first_depart = uMax
     last_depart = uMin
-    if options.dotripdefs and (not options.resume or not os.path.isfile(options.trips_for_dua)):
-        if os.path.isfile(options.rectified) and options.resume:
-            print("using previous version of %s" % options.rectified)
+    tripdefs_stage = manifest.Stage("tripdefs", [options.trips_for_dua],
+                                    [options.mapped_trips, options.vtype_file, options.bidi_taz_file],
+                                    get_stage_params(options, TRIPDEFS_OPTIONS))
+    if options.dotripdefs and not tripdefs_stage.skip(options.resume):
         suffix = BACKGROUND_TRAFFIC_SUFFIX if options.iteration_dir is None else "0"
         first_depart, last_depart = create_sumo_tripdefs(options, options.scale, suffix, {})
+        tripdefs_stage.record(options.resume)
     else:
         if os.path.isfile(options.trips_for_dua):
-            for trip in sumolib.output.parse_fast(options.trips_for_dua, 'trip', ['depart']):
-                first_depart = min(first_depart, parseTime(trip.depart))
-                last_depart = max(last_depart, parseTime(trip.depart))
+            # flows (compacted trips and clones) are sorted by their begin like in create_sumo_tripdefs
+            for entry in sumolib.output.parse(options.trips_for_dua, ["trip", "person", "flow", "personFlow"]):
+                depart = parseTime(entry.depart if entry.depart is not None else entry.begin)
+                first_depart = min(first_depart, depart)
+                last_depart = max(last_depart, depart)
             print("using previous version of %s, vehicles starting between %s and %s" %
                   (options.trips_for_dua, first_depart, last_depart))
         else:
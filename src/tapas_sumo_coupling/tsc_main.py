@@ -31,11 +31,14 @@ import sys
 import shutil
 import glob
 import json
+import hashlib
+import tempfile
 import datetime
-import time
 import multiprocessing
+import multiprocessing.connection
 import subprocess
 import importlib
+from xml.etree import ElementTree
 from psycopg2 import ProgrammingError
 
 if 'SUMO_HOME' not in os.environ:
@@ -55,10 +58,15 @@ else:
 import sumolib
 from sumolib.options import ArgumentParser
 
-from tapas_sumo_coupling import common, constants, database, get_motorway_access, get_trips, t2s, s2t_miv, s2t_pt
+from tapas_sumo_coupling import common, constants, database, get_motorway_access, get_trips, manifest, t2s, s2t_miv, s2t_pt, status
 from tapas_sumo_coupling.constants import SP, CAR_MODES, MODE
 
 DEFAULT_SIMKEY = "berlin_2010"
+# seconds between two polls while listening for notifications, only a safety net for lost notifications
+LISTEN_POLL_INTERVAL = 600.
+# the tables whose changes may start a simulation request (besides the status tables)
+REQUEST_TABLES = ["simulation_parameters"]
+
 
 def getOptions(args, argParser):
     t2s.fillOptions(argParser)
@@ -77,7 +85,19 @@ def getOptions(args, argParser):
     argParser.add_argument("--daemon", action="store_true", default=False, help="run as daemon")
     argParser.add_argument("--daemon-run-time", type=int, default=-1,
                            help="limit the up time of the daemon in seconds - e.g. for debugging ")
+    argParser.add_argument("--notify-channel", default="tsc_requests",
+                           help="postgres channel to listen on for new simulation requests (empty string disables listening)")
+    argParser.add_argument("--install-notify-triggers", action="store_true", default=False,
+                           help="install the database triggers which notify --notify-channel about new simulation requests and exit")
+    argParser.add_argument("--poll-interval", type=float, default=2.,
+                           help="maximum time in seconds between two polls for simulation requests if notifications are not available")
+    argParser.add_argument("--min-poll-interval", type=float, default=0.1,
+                           help="initial time in seconds between two polls (doubled while idle) if notifications are not available")
     argParser.add_argument("--scenarios", help="only process selected scenarios (sim_key or template dir)")
+    argParser.add_argument("--template-links", default="copy", choices=("copy", "hardlink", "symlink"),
+                           help="how to put the template files into a new scenario folder, linked files are copied only before they get modified")
+    argParser.add_argument("--net-cache-dir",
+                           help="cache the networks derived from the templates in this directory and link them into the workdir")
     argParser.add_argument('--iteration', help="iterations of faked simulation requests (ranges and ints are possible)")
     argParser.add_argument('--log', default="tsc.log", help="name of the overall log file")
     argParser.add_argument("--sim-key", help="sim_key to use when running only a single simulation")
@@ -137,8 +157,15 @@ def get_simulation_requests(options):
     return get_trips.get_active_sim_keys(options, overrides)
 
 
-def build_restricted_network(restrictions, destination_path, netfile):
+def build_restricted_network(restrictions, destination_path, netfile, list_dir=None):
+    if list_dir is None:
+        list_dir = os.path.dirname(netfile)
     typefile = os.path.join(destination_path, "restrictions.typ.xml")
+    edgefile = os.path.join(destination_path, "restricted_edges.edg.xml")
+    netOut = os.path.join(destination_path, os.path.basename(netfile))
+    common.unshare_file(typefile, keep_content=False)
+    common.unshare_file(edgefile, keep_content=False)
+    common.unshare_file(netOut, keep_content=os.path.abspath(netOut) == os.path.abspath(netfile))
     with open(typefile, 'w') as types:
         types.write("""<?xml version="1.0" encoding="UTF-8"?>
 <types xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/types_file.xsd">
@@ -153,7 +180,6 @@ def build_restricted_network(restrictions, destination_path, netfile):
             types.write('    </type>\n')
         types.write('</types>\n')
 
-    edgefile = os.path.join(destination_path, "restricted_edges.edg.xml")
     with open(edgefile, 'w') as edges:
         edges.write("""<?xml version="1.0" encoding="UTF-8"?>
 <edges xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/edgediff_file.xsd">
@@ -161,13 +187,13 @@ def build_restricted_network(restrictions, destination_path, netfile):
         for list_file in restrictions.keys():
             if ".taz.xml" in list_file:
                 f, tazId = list_file.split("@")
-                for taz in sumolib.output.parse_fast(os.path.join(os.path.dirname(netfile), f), 'taz', ['id', 'edges']):
+                for taz in sumolib.output.parse_fast(os.path.join(list_dir, f), 'taz', ['id', 'edges']):
                     if taz.id == tazId:
                         for edge in taz.edges.split():
                             edges.write('    <edge id="%s" type="%s"/>\n' %
                                         (edge, list_file))
             else:
-                for line in open(os.path.join(os.path.dirname(netfile), list_file)):
+                for line in open(os.path.join(list_dir, list_file)):
                     line = line.strip()
                     if line.startswith("edge:"):
                         line = line[5:]
@@ -177,8 +203,93 @@ def build_restricted_network(restrictions, destination_path, netfile):
                                 (line, list_file))
         edges.write('</edges>\n')
 
-    subprocess.call([sumolib.checkBinary("netconvert"), "-s", netfile, "-t", types.name, "--aggregate-warnings", "1",
-                     "-e", edges.name, "-o", os.path.join(destination_path, os.path.basename(netfile))])
+    return subprocess.call([sumolib.checkBinary("netconvert"), "-s", netfile, "-t", types.name, "--aggregate-warnings", "1",
+                            "-e", edges.name, "-o", netOut])
+
+
+def get_netccfg_inputs(cfg):
+    """returns the existing files referenced by the option values of a netconvert configuration"""
+    inputs = []
+    for element in ElementTree.parse(cfg).iter():
+        for value in element.get("value", "").split(","):
+            path = os.path.join(os.path.dirname(cfg), value.strip())
+            if value.strip() and os.path.isfile(path):
+                inputs.append(path)
+    return inputs
+
+
+def get_cached_build(cache_dir, key, build):
+    """returns the cache entry for the key, calling build(tmp_dir) to create it if it does not exist yet"""
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        print("reusing cached network build", entry)
+        return entry
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_dir = tempfile.mkdtemp(prefix=key + ".", dir=cache_dir)
+    try:
+        build(tmp_dir)
+        os.rename(tmp_dir, entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+        # a parallel request was faster building the same entry
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return entry
+
+
+def link_cached_build(entry, destination_path):
+    for f in os.listdir(entry):
+        common.link_file(os.path.join(entry, f), os.path.join(destination_path, f))
+
+
+def get_netconvert_version():
+    """returns the version output of the netconvert binary which builds the networks"""
+    return subprocess.check_output([sumolib.checkBinary("netconvert"), "--version"])
+
+
+def build_cached_network(cache_dir, net, cfgs, restrictions, destination_path):
+    """links the results of the netconvert chain and of the restrictions into the destination,
+       building them only if no identical build is in the cache already,
+       returns the result of the netconvert chain in the destination (None without netccfgs)"""
+    netName = os.path.basename(net)
+    digest = hashlib.sha1(get_netconvert_version())
+    common.hash_file(digest, net)
+    for cfg in cfgs:
+        digest.update(os.path.basename(cfg).encode())
+        common.hash_file(digest, cfg)
+        for f in get_netccfg_inputs(cfg):
+            digest.update(os.path.relpath(f, os.path.dirname(cfg)).encode())
+            common.hash_file(digest, f)
+    chain_key = digest.hexdigest()
+
+    def build_chain(build_dir):
+        current = net
+        for cfg in cfgs:
+            netTemp = os.path.join(build_dir, netName + os.path.basename(cfg))
+            common.call([sumolib.checkBinary("netconvert"), "-c", cfg, "-s", current, "-o", netTemp])
+            current = netTemp
+    chain = get_cached_build(cache_dir, chain_key, build_chain)
+    link_cached_build(chain, destination_path)
+    netTemp = os.path.join(destination_path, netName + os.path.basename(cfgs[-1])) if cfgs else None
+
+    if restrictions:
+        list_dir = destination_path if cfgs else os.path.dirname(net)
+        restricted_input = os.path.join(chain, os.path.basename(netTemp)) if cfgs else net
+        digest = hashlib.sha1(chain_key.encode())
+        digest.update(json.dumps(restrictions, sort_keys=True).encode())
+        for list_file in sorted(restrictions.keys()):
+            path = os.path.join(list_dir, list_file.split("@")[0] if ".taz.xml" in list_file else list_file)
+            if os.path.isfile(path):
+                common.hash_file(digest, path)
+
+        def build_restrictions(build_dir):
+            if build_restricted_network(restrictions, build_dir, restricted_input, list_dir) != 0:
+                raise subprocess.CalledProcessError(1, "netconvert")
+        link_cached_build(get_cached_build(cache_dir, digest.hexdigest(), build_restrictions), destination_path)
+    return netTemp
 
 
 def create_new_destination_folder(options, sim_key, iteration, params):
@@ -207,20 +318,27 @@ def create_new_destination_folder(options, sim_key, iteration, params):
             # get things from template folder
             for ext in ("xml", "xml.gz", "csv", "csv.gz", "params"):
                 for ff in glob.glob(os.path.join(template_path, '*.' + ext)):
-                    shutil.copyfile(ff, os.path.join(destination_path, os.path.basename(ff)))
+                    common.materialize_file(ff, os.path.join(destination_path, os.path.basename(ff)),
+                                            options.template_links)
             netList = glob.glob(os.path.join(template_path, 'net.net.xml*'))
             net = netList[0] if netList else glob.glob(os.path.join(template_path, '*.net.xml*'))[0]
             netOut = os.path.join(destination_path, os.path.basename(net))
-            netTemp = None
-            for cfg in sorted(glob.glob(os.path.join(template_path, '*.netccfg'))):
-                netTemp = netOut + os.path.basename(cfg)
-                subprocess.call([sumolib.checkBinary("netconvert"), "-c", cfg, "-s", net, "-o", netTemp])
-                net = netTemp
+            cfgs = sorted(glob.glob(os.path.join(template_path, '*.netccfg')))
             restrictions = json.loads(params[SP.net_param])
-            if restrictions:
-                if isinstance(restrictions, dict):
+            if options.net_cache_dir:
+                netTemp = build_cached_network(options.net_cache_dir, net, cfgs,
+                                               restrictions if isinstance(restrictions, dict) else None, destination_path)
+            else:
+                netTemp = None
+                for cfg in cfgs:
+                    netTemp = netOut + os.path.basename(cfg)
+                    common.unshare_file(netTemp, keep_content=False)
+                    subprocess.call([sumolib.checkBinary("netconvert"), "-c", cfg, "-s", net, "-o", netTemp])
+                    net = netTemp
+                if restrictions and isinstance(restrictions, dict):
                     build_restricted_network(restrictions, destination_path, net)
-                else:
+            if restrictions:
+                if not isinstance(restrictions, dict):
                     for origin, destination in restrictions:
                         os.rename(os.path.join(destination_path, origin), os.path.join(destination_path, destination))
             elif netTemp:
@@ -250,6 +368,18 @@ def create_new_iteration_folder(options, iteration, destination_path):
 
 def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
     all_pair_tables = s2t_miv.create_all_pairs(conn, sim_key, params)
+    try:
+        _run_all_pairs(options, conn, sim_key, params, final_routes, final_weights, all_pair_tables)
+    except BaseException:
+        # the connection may have been closed while t2s was running
+        abort_conn = database.get_conn(options, conn)
+        s2t_miv.abort_all_pairs(abort_conn, all_pair_tables)
+        if abort_conn is not conn:
+            abort_conn.close()
+        raise
+
+
+def _run_all_pairs(options, conn, sim_key, params, final_routes, final_weights, all_pair_tables):
     modes = set()
     vTypes = set()
     for (m, t), _ in common.csv_sequence_generator(options.tapas_trips, ("mode", "sumo_type")):
@@ -260,10 +390,10 @@ def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
     options.assignment = "bulk"
     options.trips_dir = os.path.join(options.iteration_dir, 'allpairs')
     options.weights = os.path.join(options.trips_dir, os.path.basename(final_weights))
-    if not os.path.exists(options.weights) or not options.resume:
-        s2t_miv.aggregate_weights(final_weights, params[SP.od_slices], options.weights)
-    else:
-        print("Reusing aggregated weights:", options.weights)
+    stage = manifest.Stage("weight aggregation", [options.weights], [final_weights], {"slices": params[SP.od_slices]})
+    if not stage.skip(options.resume):
+        s2t_miv.aggregate_weights(final_weights, params[SP.od_slices], options.weights, options.processes)
+        stage.record(options.resume)
     options.rectify = False
     options.scale = 1.0
     options.time_diffusion = 0
@@ -290,12 +420,17 @@ def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
                 options.tapas_trips = get_trips.tripfile_name("%s_%s%02i" % (
                     get_trips.ALL_PAIRS, mapType, end_hour), target_dir=options.trips_dir)
                 trips_file = None
-                if not os.path.exists(options.tapas_trips) or not options.resume:
+                stage = manifest.Stage("all pairs trips", [options.tapas_trips], [],
+                                       {"vType": vType, "begin": begin_second, "limit": options.limit, "seed": options.seed,
+                                        "bbox": options.representatives_bbox, "params": params})
+                if not stage.skip(options.resume):
                     trips_file = options.tapas_trips
                 get_trips.write_all_pairs(conn, vType, begin_second, options.limit, trips_file, params, options.seed,
                                           bbox=options.representatives_bbox)
+                stage.record(options.resume)
                 write_status('>>> starting all pairs t2s using tripfile %s' %
                             options.tapas_trips, sim_key, params, conn)
+                conn.commit()
                 conn.close()
                 rou_file, _ = t2s.main(options)
                 conn = database.get_conn(options, conn)
@@ -303,7 +438,7 @@ def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
                 assert os.path.exists(rou_file), "all pairs route file %s could not be found" % rou_file
             write_status('>>> starting od result database upload', sim_key, params, conn)
             startIdx = s2t_miv.upload_all_pairs(conn, all_pair_tables, begin_second, end_second, vType,
-                                                final_routes, rou_file, options.net, startIdx)
+                                                final_routes, rou_file, options.net, startIdx, options)
             write_status('<<< finished od result database upload', sim_key, params, conn)
             begin_second = end_second
     if not modes <= set(CAR_MODES):
@@ -313,6 +448,7 @@ def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
             get_trips.write_all_pairs(conn, "public", 31 * 3600, options.limit, options.tapas_trips, params,
                                       options.seed, MODE.public, bbox=options.representatives_bbox)
             write_status('>>> starting all pairs t2s using tripfile %s' % options.tapas_trips, sim_key, params, conn)
+            conn.commit()
             conn.close()
             rou_file, _ = t2s.main(options)
             conn = database.get_conn(options, conn)
@@ -320,8 +456,9 @@ def run_all_pairs(options, conn, sim_key, params, final_routes, final_weights):
             assert os.path.exists(rou_file), "all pairs route file %s could not be found" % rou_file
         write_status('>>> starting od result database upload', sim_key, params, conn)
         startIdx = s2t_pt.upload_all_pairs(conn, all_pair_tables, 31 * 3600, 32 * 3600,
-                                           final_routes, rou_file, options.net, startIdx)
+                                           final_routes, rou_file, options.net, startIdx, options)
         write_status('<<< finished od result database upload', sim_key, params, conn)
+    s2t_miv.finish_all_pairs(conn, all_pair_tables)
     write_status('<< finished all pairs calculation', sim_key, params, conn)
 
 
@@ -342,15 +479,19 @@ def cleanup(save, iteration_dir, sim_key, iteration, params, conn):
                 shutil.rmtree(os.path.join(basedir, "iteration%03i" % i))
 
 
+_status_writer = None
+_status_clock = status.StatusClock()
+
+
 def write_status(message, sim_key, params, conn=None, msg_type=constants.MSG_TYPE.info):
     print('db_status_%s: %s %s %s' %
           (msg_type, sim_key, params[SP.iteration], message))
     if conn is not None and sim_key is not None:
-        command = "INSERT INTO public.%s (sim_key, iteration, status_time, status, msg_type) VALUES (?, ?, ?, ?, ?);"
-        database.execute(conn, command % params[SP.status],
-                               (sim_key, params[SP.iteration], datetime.datetime.now(), str(message), msg_type))
-        # make sure the time stamp is unique, otherwise the primary key is violated
-        time.sleep(0.01)
+        if _status_writer is not None:
+            _status_writer.write(sim_key, params[SP.iteration], message, msg_type)
+        else:
+            command = "INSERT INTO public.%s (%s) VALUES (?, ?, ?, ?, ?);" % (params[SP.status], status.COLUMNS)
+            database.execute(conn, command, (sim_key, params[SP.iteration], _status_clock.now(), str(message), msg_type))
 
 
 def get_script_module(options, template):
@@ -368,6 +509,7 @@ def get_script_module(options, template):
 
 
 def simulation_request(options, request):
+    global _status_writer
     conn = None
     sim_key, iteration, params = request
     try:
@@ -375,6 +517,8 @@ def simulation_request(options, request):
         conn = database.get_conn(options)
         if conn is None:
             print("Warning! No database connection given, operating on files only.")
+        else:
+            _status_writer = status.StatusWriter(options, params[SP.status])
 
         write_status("> Begin", sim_key, params, conn, constants.MSG_TYPE.started)
         print(sorted(params.items()))
@@ -393,14 +537,20 @@ def simulation_request(options, request):
         options.tapas_trips = os.path.join(scenario_basedir, "background_traffic.csv")
         if iteration == 0 and params[SP.add_traffic_table] not in (None, '', 'none') and conn is not None:
 #            options.modes = ','.join(CAR_MODES)
-            if not os.path.exists(options.tapas_trips) or not options.resume:
+            stage = manifest.Stage("background trip download", [options.tapas_trips], [],
+                                   {"table": params[SP.add_traffic_table], "limit": options.limit, "params": params})
+            if not stage.skip(options.resume):
+                common.unshare_file(options.tapas_trips, keep_content=False)
                 get_trips.write_background_trips(conn, params[SP.add_traffic_table],
                                                  options.limit, options.tapas_trips, params)
+                stage.record(options.resume)
             options.location_priority_file = os.path.abspath(os.path.join(scenario_basedir, 'location_priorities.xml'))
+            common.unshare_file(options.location_priority_file, keep_content=False)
             get_motorway_access.save_locations(options.location_priority_file, options, params[SP.add_traffic_table])
             options.trips_dir = scenario_basedir
             write_status('>> starting trip generation for background traffic using tripfile %s' %
                          options.tapas_trips, sim_key, params, conn)
+            conn.commit()
             conn.close()
             options.background_trips, _ = t2s.main(options)
             options.location_priority_file = ""
@@ -422,12 +572,17 @@ def simulation_request(options, request):
         else:
             assert sim_key is not None, 'no sim_key for db given'
             options.tapas_trips = get_trips.tripfile_name(sim_key, target_dir=options.trips_dir)
-            if not os.path.exists(options.tapas_trips) or not options.resume:
-                get_trips.write_trips(conn, sim_key, options.limit, options.tapas_trips, params)
+            stage = manifest.Stage("trip download", [options.tapas_trips], [],
+                                   {"sim_key": sim_key, "limit": options.limit, "params": params})
+            if not stage.skip(options.resume):
+                get_trips.write_trips(conn, sim_key, options.limit, options.tapas_trips, params, options)
+                stage.record(options.resume)
         print()
         write_status('>> starting t2s using tripfile %s' %
                      options.tapas_trips, sim_key, params, conn)
         if conn is not None:
+            # do not keep the connection open while t2s runs (and forks its process pools)
+            conn.commit()
             conn.close()
 
         # run t2s
@@ -451,16 +606,23 @@ def simulation_request(options, request):
         if conn is not None:
             print()
             conn = database.get_conn(options, conn)
+            # parse the routes only once for the trip result upload and all pair calculations
+            route_index = s2t_miv.RouteIndex(final_routes, options.processes)
             # upload trip results to db
             _, _, exists = database.check_schema_table(conn, 'temp', '%s_%s' % (params[SP.trip_output], sim_key))
-            if not exists or not options.resume:
+            stage = manifest.Stage("trip result upload", [], [final_routes, options.trip_emissions],
+                                   {"sim_key": sim_key, "params": params},
+                                   os.path.join(options.iteration_dir, "trip_upload" + manifest.SUFFIX))
+            if not exists or not stage.skip(options.resume):
                 write_status('>> starting trip result database upload', sim_key, params, conn)
-                s2t_miv.upload_trip_results(conn, sim_key, params, final_routes, options.trip_emissions)
+                s2t_miv.upload_trip_results(conn, sim_key, params, route_index, options.trip_emissions,
+                                            processes=options.processes, options=options)
                 write_status('<< finished trip result database upload', sim_key, params, conn)
+                stage.record(options.resume)
                 print()
             # run all pair calculations
             conn = database.get_conn(options, conn)
-            run_all_pairs(options, conn, sim_key, params, final_routes, final_weights)
+            run_all_pairs(options, conn, sim_key, params, route_index, final_weights)
 
         conn = database.get_conn(options, conn)
         cleanup([final_routes, final_weights], options.iteration_dir,
@@ -474,10 +636,28 @@ def simulation_request(options, request):
         write_status(message, sim_key, params, conn, constants.MSG_TYPE.error)
 
     # exit gracefully
+    if _status_writer is not None:
+        try:
+            _status_writer.close()
+        except IOError as e:
+            print("Error!", e, file=sys.stderr)
+        _status_writer = None
     if conn is not None:
         conn.close()
 
 
+def wait_for_events(listen_conn, processes, timeout):
+    """waits until a notification arrives, a simulation process ends or the timeout expires,
+       returns whether anything happened"""
+    waitables = [p.sentinel for p in processes.values()]
+    if listen_conn is not None:
+        waitables.append(listen_conn)
+    ready = multiprocessing.connection.wait(waitables, timeout)
+    if listen_conn is not None and listen_conn in ready:
+        database.consume_notifications(listen_conn)
+    return len(ready) > 0
+
+
 def main(args=None):
     # get the options
     argParser = ArgumentParser()
@@ -499,7 +679,25 @@ def main(args=None):
             conn.close()
         return
 
+    if options.install_notify_triggers:
+        conn = database.get_conn(options)
+        if conn is None or not options.notify_channel:
+            print("Warning! Notifications need a postgres database and a notify channel.")
+        else:
+            tables = REQUEST_TABLES + get_trips.get_status_tables(conn)
+            database.install_notify_triggers(conn, options.notify_channel, tables)
+            print("Installed notification triggers for %s." % ", ".join(tables))
+        if conn is not None:
+            conn.close()
+        return
+
     processes = {}
+    iterations = {}
+    listen_conn = None
+    unnotified = None
+    if options.daemon and options.notify_channel:
+        listen_conn = database.listen(options, options.notify_channel)
+    poll_interval = options.min_poll_interval
     now = datetime.datetime.now()
     if options.daemon_run_time > 0:
         daemon_end_time = now + datetime.timedelta(seconds=options.daemon_run_time)
@@ -510,24 +708,50 @@ def main(args=None):
         for key in list(processes.keys()):
             if not processes[key].is_alive():
                 del processes[key]
+                del iterations[key]
         # check for a new simulation request
+        started = False
         for request in get_simulation_requests(options):
-            if request[0] in processes:  # this should happen in tests only
+            if request[0] in processes:
+                if iterations[request[0]] == request[1]:  # still starting up, the status is not yet written
+                    continue
+                # this should happen in tests only
                 processes[request[0]].join()
                 del processes[request[0]]
+                del iterations[request[0]]
             if len(processes) >= options.parallel:
                 break
             processes[request[0]] = multiprocessing.Process(
                 target=simulation_request, args=(options, request))
             processes[request[0]].start()
+            iterations[request[0]] = request[1]
+            started = True
         if not options.daemon:
             break
-        time.sleep(2)
+        notified = False
+        if listen_conn is not None:
+            # without a trigger on every watched table, notifications may be missing and we keep polling
+            tables = REQUEST_TABLES + get_trips.get_status_tables(listen_conn)
+            missing = set(tables) - database.get_notifying_tables(listen_conn, options.notify_channel, tables)
+            if missing != unnotified and missing:
+                print("Warning! No notification trigger on %s, polling every %s seconds (see --install-notify-triggers)." %
+                      (", ".join(sorted(missing)), options.poll_interval))
+            unnotified = missing
+            notified = not missing
+        if started or notified:
+            poll_interval = options.min_poll_interval
+        timeout = LISTEN_POLL_INTERVAL if notified else poll_interval
+        if daemon_end_time != datetime.datetime.max:
+            timeout = max(0., min(timeout, (daemon_end_time - datetime.datetime.now()).total_seconds()))
+        if not wait_for_events(listen_conn, processes, timeout):
+            poll_interval = min(2 * poll_interval, options.poll_interval)
         prev = now
         now = datetime.datetime.now()
         if prev.hour != now.hour:
             print("still listening", now)
 
+    if listen_conn is not None:
+        listen_conn.close()
     for p in processes.values():
         p.join()
 
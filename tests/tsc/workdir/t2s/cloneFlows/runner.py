@@ -0,0 +1,10 @@
+import os
+import subprocess
+import tscdefs
+
+tripFile = '2013y_03m_07d_16h_43m_41s_859ms_limit1000.csv'
+net = os.path.join('scenario_workdir', 'mitte_net', 'net.net.xml.gz')
+trips_dir = os.path.join('scenario_workdir', 'mitte_net', 'iteration000', 'trips')
+
+os.chdir("data")
+subprocess.call(tscdefs.get_python_tool("t2s.py", None) + ['--net-file', net, '--trips-dir', trips_dir, '--tapas-trips', tripFile, '--scale', '2', '--clone-flows'])
@@ -0,0 +1,21 @@
+import os
+import csv
+import subprocess
+import tscdefs
+
+tripFile = '2013y_03m_07d_16h_43m_41s_859ms_limit1000.csv'
+net = os.path.join('scenario_workdir', 'mitte_net', 'net.net.xml.gz')
+trips_dir = os.path.join('scenario_workdir', 'mitte_net', 'iteration000', 'trips')
+
+os.chdir("data")
+# every person gets two twins with identical trips which can be compacted
+with open(tripFile) as f:
+    rows = list(csv.reader(f))
+duplicatedFile = 'duplicated.csv'
+with open(duplicatedFile, 'w') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(rows[0])
+    for twin in range(3):
+        writer.writerows([[str(int(r[0]) + twin * 1000000)] + r[1:] for r in rows[1:]])
+subprocess.call(tscdefs.get_python_tool("t2s.py", None) + ['--net-file', net, '--trips-dir', trips_dir, '--tapas-trips', duplicatedFile,
+                                                           '--compact-trips', '--time-diffusion', '0'])
@@ -0,0 +1,28 @@
+import os
+import csv
+import shutil
+import subprocess
+import tscdefs
+
+tripFile = '2013y_03m_07d_16h_43m_41s_859ms_limit1000.csv'
+net = os.path.join('scenario_workdir', 'mitte_net', 'net.net.xml.gz')
+previous_dir = os.path.join('scenario_workdir', 'mitte_net', 'previous', 'trips')
+iteration_dir = os.path.join('scenario_workdir', 'mitte_net', 'iteration000')
+trips_dir = os.path.join(iteration_dir, 'trips')
+
+os.chdir("data")
+os.makedirs(previous_dir)
+subprocess.call(tscdefs.get_python_tool("t2s.py", None) + ['--net-file', net, '--trips-dir', previous_dir, '--tapas-trips', tripFile, '--incremental'])
+shutil.copy(tripFile, previous_dir)
+# change the first trip and drop the last person, all other persons are taken from the previous run
+with open(tripFile) as f:
+    rows = list(csv.reader(f))
+header = rows[0]
+start = header.index('start_time_min')
+rows[1][start] = str(int(rows[1][start]) - 10)
+last_person = rows[-1][:2]
+changedFile = os.path.join(iteration_dir, tripFile)
+with open(changedFile, 'w') as f:
+    csv.writer(f, lineterminator='\n').writerows([r for r in rows if r[:2] != last_person])
+subprocess.call(tscdefs.get_python_tool("t2s.py", None) + ['--net-file', net, '--trips-dir', trips_dir, '--tapas-trips', changedFile,
+                                                           '--incremental', '--previous-trips-dir', previous_dir])